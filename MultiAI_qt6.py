@@ -2,22 +2,35 @@ import sys
 import os
 import aiohttp
 import asyncio
+import codecs
 from datetime import datetime
 from dotenv import load_dotenv
 import edge_tts
+from email.utils import parsedate_to_datetime
+import hashlib
+from html.parser import HTMLParser
 import json
 from playsound import playsound
 import logging
-from openai import OpenAI
+import numpy as np
+from openai import OpenAI, Timeout
 import queue
 import re
 import requests
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QLabel, QTextEdit, QVBoxLayout, QPushButton, QLineEdit,
-    QFileDialog, QComboBox, QMenuBar, QMainWindow, QMessageBox, QInputDialog
+    QFileDialog, QComboBox, QMenuBar, QMainWindow, QMessageBox, QInputDialog,
+    QDialog, QTableWidget, QTableWidgetItem, QHeaderView
 )
-from PyQt6.QtGui import QTextCursor, QTextBlockFormat, QFont, QBrush, QColor, QTextCharFormat, QAction 
-from PyQt6.QtCore import Qt, QEvent, QObject, pyqtSignal, QThread
+from PyQt6.QtGui import QTextCursor, QTextBlockFormat, QFont, QBrush, QColor, QTextCharFormat, QAction, QActionGroup, QShortcut, QKeySequence
+from PyQt6.QtCore import Qt, QEvent, QObject, QTimer, pyqtSignal
 
 # 初始化日志记录器
 logger = logging.getLogger(__name__)
@@ -32,6 +45,10 @@ class MultiAI(QMainWindow):
     """
     play_audio_signal = pyqtSignal()  # 新增信号
     playback_error_signal = pyqtSignal(str)  # 新增错误信号
+    scheduler_changed_signal = pyqtSignal()  # 请求队列状态变化信号
+    model_state_signal = pyqtSignal()  # 本地模型加载状态变化信号
+    local_models_signal = pyqtSignal(object)  # 本地模型查询完成信号，参数为模型列表或 None
+    benchmark_signal = pyqtSignal(object)  # 本地模型测速完成信号
     def __init__(self):
         """
         初始化 MultiAI 应用程序，包括文本到语音引擎、API 客户端、模型配置以及 GUI 界面。
@@ -44,13 +61,16 @@ class MultiAI(QMainWindow):
         self.height = 900
 
         # 初始化内部变量 prompt_template
-        self.web_context = ""
+        # 检索结果按 URL 去重保存，构造提示词时按相关度与时效挑选，总量不超过 web_context_tokens
+        self.web_context = WebContextStore(max_records=int(os.getenv("WEB_CONTEXT_SIZE", "100")))
+        self.web_context_tokens = int(os.getenv("WEB_CONTEXT_TOKENS", "1500"))
+        self.web_context_ratio = float(os.getenv("WEB_CONTEXT_RATIO", "0.25"))
         self.user_query = ""
         self.prompt_template = f"""
 [系统指令]                            
 你是一个AI助手, 当前日期为{datetime.now().strftime('%Y-%m-%d')}。
 以下是来自网络的实时信息片段(可能不完整):\n
-{self.web_context}
+
 
 [用户问题]
 {self.user_query}
@@ -63,14 +83,21 @@ class MultiAI(QMainWindow):
         except Exception as e:
             print(f"Failed to initialize TTS: {e}")
 
+        # API 请求超时：连接超时与两次数据之间的读取超时（秒），避免无响应的请求长期占用工作线程
+        api_timeout = Timeout(float(os.getenv("API_READ_TIMEOUT", "120")),
+                              connect=float(os.getenv("API_CONNECT_TIMEOUT", "10")))
         self.clients = {
             "local_deepseek-r1:7b": None,  # 本地模型不依赖 API 客户端
             "local_deepseek-r1:32b": None,
             "local_deepseek-r1:70b": None,
-            "api_openai": OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url="https://api.feidaapi.com/v1"),
-            "api_deepseek": OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com"),
-            "api_siliconflow": OpenAI(api_key=os.getenv("SILICONFLOW_API_KEY"), base_url="https://api.siliconflow.cn/v1"),
-            "api_kimi": OpenAI(api_key=os.getenv("KIMI_API_KEY"), base_url="https://api.moonshot.cn/v1"),
+            "api_openai": OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url="https://api.feidaapi.com/v1",
+                                 timeout=api_timeout),
+            "api_deepseek": OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com",
+                                   timeout=api_timeout),
+            "api_siliconflow": OpenAI(api_key=os.getenv("SILICONFLOW_API_KEY"), base_url="https://api.siliconflow.cn/v1",
+                                      timeout=api_timeout),
+            "api_kimi": OpenAI(api_key=os.getenv("KIMI_API_KEY"), base_url="https://api.moonshot.cn/v1",
+                               timeout=api_timeout),
         }
         self.models = {
             "local_deepseek-r1:7b": "deepseek-r1:latest",
@@ -83,6 +110,131 @@ class MultiAI(QMainWindow):
         }
         self.current_model = "local_deepseek-r1:7b"
         self.all_messages = [{"role": "system", "content": "You are a helpful assistant"}]
+        self.hedge_delay_ms = 0  # 竞速模式下启动备用模型前等待主模型首个 token 的时间
+
+        # 本地 Ollama 服务：复用连接的会话，超时为（连接, 两次数据之间的读取）秒数
+        self.ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434").rstrip("/")
+        self.ollama = requests.Session()
+        self.ollama.mount("http://", requests.adapters.HTTPAdapter(
+            pool_maxsize=int(os.getenv("REQUEST_WORKERS", "8"))))
+        self.ollama_timeout = (float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5")),
+                               float(os.getenv("OLLAMA_READ_TIMEOUT", "300")))
+        # 本地模型生命周期：选中时预加载，按模型设置 keep_alive，空闲超时后由 Ollama 卸载
+        self.model_manager = LocalModelManager(
+            self.ollama, self.ollama_url, self.ollama_timeout,
+            keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+            overrides=parse_overrides(os.getenv("OLLAMA_KEEP_ALIVE_OVERRIDES", "deepseek-r1:70b=10m")),
+        )
+        self.model_manager.on_change = self.model_state_signal.emit
+        self.model_state_signal.connect(self.refresh_model_selector)
+
+        # token 计数与各模型的用量/速度指标
+        self.token_counter = TokenCounter()
+        self.metrics = ModelMetrics()
+
+        # 上下文窗口管理：超出窗口的早期对话由 summary_model 在后台折叠为摘要
+        self.context_manager = ContextManager(
+            self.token_counter,
+            {
+                "gpt-4o": 128000,
+                "gpt-4o-mini": 128000,
+                "Qwen/Qwen2.5-7B-Instruct": 32768,
+                "deepseek-chat": 64000,
+                "deepseek-ai/DeepSeek-R1": 64000,
+                "moonshot-v1-8k": 8192,
+            },
+            default_window=int(os.getenv("LOCAL_CONTEXT_WINDOW", "4096")),
+            keep_recent=int(os.getenv("CONTEXT_KEEP_RECENT", "6")),
+        )
+        # 为空时跟随对话所用的模型：本地对话用最小的本地模型摘要，
+        # API 对话用同一提供方的廉价模型（SUMMARY_CHEAP_MODELS 中没有配置的提供方用对话所用的模型）
+        self.summary_model = os.getenv("SUMMARY_MODEL", "")
+        self.summary_cheap_models = parse_overrides(os.getenv(
+            "SUMMARY_CHEAP_MODELS", "api_openai=gpt-4o-mini,api_siliconflow=Qwen/Qwen2.5-7B-Instruct"))
+        # "auto" 模式：按各模型的实时延迟、生成速度与错误率为每个问题选择模型
+        self.router = ModelRouter(expected_tokens=int(os.getenv("ROUTER_EXPECTED_TOKENS", "400")))
+        self.router_load_penalty = float(os.getenv("ROUTER_LOAD_PENALTY", "15"))
+        self.router_probe_interval = float(os.getenv("ROUTER_PROBE_INTERVAL", "120"))
+        self.last_local_model = None  # 保存对话时记录，加载后用于预填充
+        self.worker = None  # 当前正在显示回复的任务
+        self.stream_text = ""
+        self.conversation_id = 0  # 清除或加载对话时递增，调度器按对话保证请求顺序
+
+        # 请求调度器：复用线程池，并限制本地模型与各 API 的并发请求数
+        self.scheduler = RequestScheduler(
+            max_workers=int(os.getenv("REQUEST_WORKERS", "8")),
+            local_limit=int(os.getenv("LOCAL_CONCURRENCY", "1")),
+            api_limit=int(os.getenv("API_CONCURRENCY", "4")),
+            inner_workers=int(os.getenv("REQUEST_INNER_WORKERS", "16")),
+        )
+        self.scheduler.on_change = self.scheduler_changed_signal.emit
+        self.scheduler_changed_signal.connect(self.update_queue_status)
+
+        # 应用共用的后台事件循环，负责联网搜索、网页抓取与语音合成等异步网络 I/O
+        self.async_loop = AsyncLoopThread()
+
+        # 长期复用的联网搜索客户端，连接池与超时可通过环境变量调整
+        self.search_client = WebSearchClient(
+            self.async_loop,
+            proxy_url=os.getenv("PROXY_URL"),
+            timeout=float(os.getenv("SEARCH_TIMEOUT", "15")),
+            connect_timeout=float(os.getenv("SEARCH_CONNECT_TIMEOUT", "5")),
+            pool_size=int(os.getenv("SEARCH_POOL_SIZE", "10")),
+        )
+        # 深度搜索（默认关闭）：并发抓取前 deep_search_top_k 个结果页面，提取正文并按问题挑选片段
+        self.deep_search_enabled = os.getenv("DEEP_SEARCH", "0") == "1"
+        self.deep_search_top_k = int(os.getenv("DEEP_SEARCH_TOP_K", "3"))
+        self.deep_search_timeout = float(os.getenv("DEEP_SEARCH_TIMEOUT", "4"))
+        self.deep_search_chunks = int(os.getenv("DEEP_SEARCH_CHUNKS", "3"))
+        # 检索摘要（默认关闭）：检索内容较长时先由小的本地模型 map-reduce 摘要，再交给回答模型
+        self.search_summary_enabled = os.getenv("SEARCH_SUMMARY", "0") == "1"
+        self.search_summary_model_name = os.getenv("SEARCH_SUMMARY_MODEL", "")
+        self.search_summary_min_tokens = int(os.getenv("SEARCH_SUMMARY_MIN_TOKENS", "800"))
+        self.search_summary_input_tokens = int(os.getenv("SEARCH_SUMMARY_INPUT_TOKENS", "4000"))
+        self.search_summary_chunk_tokens = int(os.getenv("SEARCH_SUMMARY_CHUNK_TOKENS", "1000"))
+        self.search_summary_parallel = int(os.getenv("SEARCH_SUMMARY_PARALLEL", "2"))
+        # 检索判断（默认开启）：联网搜索按下时逐条判断问题是否需要检索，可选用小的本地模型判断不确定的问题
+        self.search_classifier_enabled = os.getenv("SEARCH_CLASSIFIER", "1") == "1"
+        self.search_classifier_model = os.getenv("SEARCH_CLASSIFIER_MODEL", "")
+        self.search_classifier_timeout = float(os.getenv("SEARCH_CLASSIFIER_TIMEOUT", "3"))
+        self.search_classifier = SearchClassifier(
+            ask=self.classify_with_model if self.search_classifier_model else None)
+        self.page_fetcher = PageFetcher(
+            self.async_loop,
+            proxy_url=os.getenv("PROXY_URL"),
+            pool_size=int(os.getenv("SEARCH_POOL_SIZE", "10")),
+            per_host=int(os.getenv("DEEP_SEARCH_PER_HOST", "2")),
+            cache=PageCache(
+                os.getenv("PAGE_CACHE_PATH", "page_cache.sqlite3"),
+                max_bytes=int(float(os.getenv("PAGE_CACHE_SIZE_MB", "100")) * 1024 * 1024),
+                default_ttl=float(os.getenv("PAGE_CACHE_DEFAULT_TTL", "3600")),
+            ),
+        )
+        # 搜索结果缓存：内存 LRU + SQLite 持久化，过期时间单位为秒
+        self.search_cache = PersistentCache(
+            os.getenv("SEARCH_CACHE_PATH", "search_cache.sqlite3"),
+            table="search_cache",
+            ttl=float(os.getenv("SEARCH_CACHE_TTL", "21600")),
+            memory_size=int(os.getenv("SEARCH_CACHE_SIZE", "256")),
+            max_entries=2000,
+        )
+        # 回答缓存（默认关闭）：按模型、消息列表与采样参数精确匹配
+        self.response_cache_enabled = False
+        self.response_cache = PersistentCache(
+            os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3"),
+            table="response_cache",
+            memory_size=64,
+            max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "500")),
+        )
+        # 语义缓存（默认关闭）：用本地 Ollama 嵌入向量匹配意思相近的问题
+        self.semantic_cache_enabled = False
+        self.semantic_cache = SemanticCache(
+            os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.npz"),
+            embed_model=os.getenv("SEMANTIC_CACHE_MODEL", "nomic-embed-text"),
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+            base_url=self.ollama_url,
+            session=self.ollama,
+        )
 
         self.setup_gui()
 
@@ -93,100 +245,408 @@ class MultiAI(QMainWindow):
             "top_p": 0.9,
         }
 
-    async def async_web_search(self, query: str):
+        # 后台查询已安装的本地模型，完成后更新模型列表并预加载默认模型；定期同步本地模型的加载状态
+        self.model_chosen = False  # 用户是否手动选择过模型，选择过则不再自动切换默认模型
+        self.local_model_info = {}  # 模型名 -> /api/tags 中的大小与参数量
+        self.local_models_signal.connect(self.apply_local_models)
+        self.benchmark_signal.connect(self.show_local_benchmark)
+        self.scheduler.executor.submit(lambda: self.local_models_signal.emit(self.model_manager.installed()))
+        self.model_state_timer = QTimer(self)
+        self.model_state_timer.timeout.connect(self.poll_model_states)
+        self.model_state_timer.start(int(float(os.getenv("OLLAMA_PS_INTERVAL", "30")) * 1000))
+        self.router_probe_timer = QTimer(self)
+        self.router_probe_timer.timeout.connect(self.probe_models)
+        self.router_probe_timer.start(int(self.router_probe_interval * 1000))
+
+    async def async_web_search(self, query: str, num: int = 10):
         """
-        异步执行网络搜索，使用 google.serper API 返回前10个搜索结果内容列表。
+        异步执行网络搜索，使用 google.serper API 返回前 num 个搜索结果内容列表。
+        请求经由长期复用的 self.search_client 会话发出，需在 self.async_loop 中运行。
         """
+        cache_key = self.search_cache_key(query, num)
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"搜索缓存命中: {cache_key} ({self.search_cache.stats()})")
+            return cached
+
         api_key = os.getenv("SERPER_API_KEY")
         if api_key is None:
             logger.error("SERPER_API_KEY 未设置")
             return []
-        headers = {
-            "X-API-KEY": api_key,
-            "Content-Type": "application/json"
-        }
         logger.info(f"web search Using API key: {api_key}")
-        proxy_url = os.getenv("PROXY_URL")
-        async with aiohttp.ClientSession() as session:
-            try:
-                if proxy_url:
-                    async with session.post(
-                        "https://google.serper.dev/search",
-                        headers=headers,
-                        json={"q": query, "num": 5},
-                        proxy=proxy_url
-                    ) as response:
-                        response.raise_for_status()
-                        data = await response.json()
-                else:
-                    async with session.post(
-                        "https://google.serper.dev/search",
-                        headers=headers,
-                        json={"q": query, "num": 10}
-                    ) as response:
-                        response.raise_for_status()
-                        data = await response.json()
-                return data.get("organic", [])[:10]
-            except aiohttp.ClientError as e:
-                logger.error(f"ClientError: {e}")
-            except ValueError as e:
-                logger.error(f"JSON error: {e}")
-            except Exception as e:
-                logger.error(f"Unknown error: {e}")
+        try:
+            results = await self.search_client.search(query, api_key, num=num)
+            if results:
+                self.search_cache.set(cache_key, results)
+            return results
+        except aiohttp.ClientError as e:
+            logger.error(f"ClientError: {e}")
+        except asyncio.TimeoutError:
+            logger.error(f"搜索超时: {query}")
+        except ValueError as e:
+            logger.error(f"JSON error: {e}")
+        except Exception as e:
+            logger.error(f"Unknown error: {e}")
         return []
 
+    @staticmethod
+    def search_cache_key(query, num):
+        """
+        生成搜索缓存键：忽略大小写并合并空白，附带结果数量，与是否使用代理无关。
+        """
+        return f"{' '.join(query.casefold().split())}|{num}"
+
     def web_search(self, query):
         """
-        同步封装的网络搜索接口，调用异步方法 async_web_search 获取搜索结果。
+        同步封装的网络搜索接口，调用异步方法 async_web_search 获取搜索结果并记入 self.web_context。
+        返回新增（此前未收录的 URL）结果数。
         """
         try:
-            results = asyncio.run(self.async_web_search(query))
-            if results:
-                formatted_results = "\n\n".join(
-                    f"Title: {result.get('title', 'N/A')}\nLink: {result.get('link', 'N/A')}\nSnippet: {result.get('snippet', 'N/A')}"
-                    for result in results
+            results = self.async_loop.run(self.async_web_search(query))
+        except Exception as e:
+            logger.error(f"搜索异常: {e}")
+            return 0
+        if not results:
+            logger.info(f"未找到搜索结果: {query}")
+            return 0
+        if self.deep_search_enabled:
+            results = self.deep_search(query, results)
+        added = self.web_context.add(query, results)
+        logger.info(f"搜索 {query}: {len(results)} 条结果, 新增 {added} 条, 共 {len(self.web_context)} 条")
+        return added
+
+    def deep_search(self, question, results):
+        """
+        深度搜索：在 deep_search_timeout 秒内并发抓取前 deep_search_top_k 个结果页面，
+        把正文切分为片段并按与 question 的相关度排序，最相关的几个片段作为结果的 content。
+        返回新的结果列表，不修改传入（可能来自缓存）的结果。
+        """
+        started = time.perf_counter()
+        links = [result["link"] for result in results[:self.deep_search_top_k] if result.get("link")]
+        try:
+            pages = self.async_loop.run(self.page_fetcher.fetch_all(links, self.deep_search_timeout),
+                                        timeout=self.deep_search_timeout + 5)
+        except Exception as e:
+            logger.warning(f"深度搜索失败: {e}")
+            return results
+        enriched = []
+        for result in results:
+            paragraphs = pages.get(result.get("link"))
+            if paragraphs:
+                chunks = rank_chunks(question, chunk_paragraphs(paragraphs))
+                result = {**result, "content": "\n".join(chunks[:self.deep_search_chunks])}
+            enriched.append(result)
+        logger.info(f"深度搜索: 抓取 {len(pages)}/{len(links)} 个页面, 用时 {time.perf_counter() - started:.2f}s")
+        return enriched
+
+    def web_context_budget(self, model_keys):
+        """
+        检索内容的 token 预算：不超过 web_context_tokens，也不超过 model_keys 中最小上下文窗口的 web_context_ratio。
+        """
+        windows = [self.context_manager.window(self.models[key]) for key in model_keys if key in self.models]
+        if not windows:
+            return self.web_context_tokens
+        return min(self.web_context_tokens, int(min(windows) * self.web_context_ratio))
+
+    def prepare_prompt(self, question, model_keys, on_stats=None, force_search=False, cancel_event=None,
+                       search=None, stages=None):
+        """
+        为 model_keys（共用同一提示词的模型）准备本轮提示词：按需联网检索（force_search 时本条必定检索），
+        把检索内容按预算做抽取式压缩（只保留与问题最相关的句子），开启检索摘要时再由小模型 map-reduce 摘要。
+        调用方已用 should_search 判断过时通过 search 传入结果（及记录判断耗时的 stages），避免重复判断。
+        各阶段耗时通过 on_stats 以 {"stages": {...}} 回传；各阶段之间 cancel_event 被置位时抛出 RequestCancelled。
+        """
+        stages = {} if stages is None else stages
+        if search is None:
+            search = self.should_search(question, force_search, stages)
+        if search:
+            raise_if_cancelled(cancel_event)
+            started = time.perf_counter()
+            self.web_search(question)
+            stages["检索"] = time.perf_counter() - started
+            self.search_classifier.record_search(stages["检索"])
+
+        raise_if_cancelled(cancel_event)
+        started = time.perf_counter()
+        budget = self.web_context_budget(model_keys)
+        summarize = self.search_summary_enabled and len(self.web_context) > 0
+        # 摘要时先取更多材料，由小模型浓缩到预算以内
+        web_context = self.web_context.pack(question, max(budget, self.search_summary_input_tokens) if summarize else budget)
+        if web_context:
+            stages["压缩"] = time.perf_counter() - started
+            logger.info(f"检索内容压缩: {len(self.web_context)} 条结果 -> 约 {estimate_tokens(web_context)} tokens"
+                        f"（预算 {budget}）, 用时 {stages['压缩'] * 1000:.1f}ms")
+        if summarize and estimate_tokens(web_context) > self.search_summary_min_tokens:
+            web_context = self.summarize_web_context(question, web_context, budget, stages, cancel_event)
+        raise_if_cancelled(cancel_event)
+
+        if stages and on_stats is not None:
+            on_stats({"stages": stages})
+        return self.build_prompt(question, web_context)
+
+    def should_search(self, question, force_search=False, stages=None):
+        """
+        判断本条问题是否联网检索：force_search 时总是检索；“联网搜索”按钮未按下时不检索；
+        否则开启检索判断时由 search_classifier 决定，并记录判断理由与跳过检索节省的时间。
+        """
+        if force_search:
+            logger.info(f"强制检索: {question[:40]}")
+            return True
+        if not (hasattr(self, 'search_button') and self.search_button.isChecked()):
+            return False
+        if not self.search_classifier_enabled:
+            return True
+        started = time.perf_counter()
+        needed, reason = self.search_classifier.decide(question)
+        elapsed = time.perf_counter() - started
+        if stages is not None:
+            stages["检索判断"] = elapsed
+        if needed:
+            logger.info(f"检索判断: 检索（{reason}）, 判断用时 {elapsed * 1000:.1f}ms: {question[:40]}")
+        else:
+            saved = self.search_classifier.record_skip()
+            logger.info(f"检索判断: 跳过（{reason}）, 判断用时 {elapsed * 1000:.1f}ms, 约节省 {saved:.2f}s"
+                        f"（累计跳过 {self.search_classifier.snapshot()['skipped']} 次）: {question[:40]}")
+        return needed
+
+    def classify_with_model(self, question):
+        """
+        让 SEARCH_CLASSIFIER_MODEL 指定的小模型判断问题是否需要联网检索，返回 True/False，无法判断或失败时返回 None。
+        等待本地并发配额或请求超过 search_classifier_timeout 秒都视为失败。
+        """
+        model = self.search_classifier_model
+        prompt = (f"判断回答下面的问题是否需要查询互联网上的最新信息或具体事实。只回答“是”或“否”。\n\n问题：{question}")
+        try:
+            # 与其他本地请求共用并发配额；关闭推理（think），否则推理模型会把 token 全部用在 <think> 中
+            with self.scheduler.provider_slot(f"local_{model}", timeout=self.search_classifier_timeout):
+                response = self.ollama.post(
+                    f"{self.ollama_url}/api/chat",
+                    json={"model": model, "messages": [{"role": "user", "content": prompt}], "stream": False,
+                          "think": False,
+                          "options": {**self.ollama_options(model), "num_predict": 8, "temperature": 0},
+                          "keep_alive": self.model_manager.keep_alive_for(model)},
+                    timeout=self.search_classifier_timeout,
                 )
-                return formatted_results
-            else:
-                return "未找到搜索结果"
+            response.raise_for_status()
         except Exception as e:
-            return f"搜索异常: {e}"
+            logger.warning(f"检索判断模型调用失败 ({model}): {e}")
+            return None
+        answer = strip_think(response.json()["message"]["content"]).strip().lower()
+        if re.match(r"(是|需要|yes\b)", answer):
+            return True
+        if re.match(r"(否|不|no\b)", answer):
+            return False
+        return None
+
+    def show_search_classifier(self):
+        stats = self.search_classifier.snapshot()
+        state = "开启" if self.search_classifier_enabled else "关闭"
+        model = self.search_classifier_model or "无（仅规则）"
+        self.output_area_sys_message(
+            f"检索判断{state}, 判断模型 {model}: 检索 {stats['searched']} 次, 跳过 {stats['skipped']} 次, "
+            f"近期单次检索约 {stats['search_seconds']:.2f}s, 累计约节省 {stats['saved_seconds']:.1f}s")
+
+    def toggle_search_classifier(self, checked):
+        self.search_classifier_enabled = checked
+        state = "开启" if checked else "关闭"
+        self.output_area_sys_message(f"检索判断已{state}")
+
+    def smallest_local_model(self):
+        """
+        已安装的参数量最小的本地模型的 model_key，没有本地模型时返回 None。
+        """
+        local_keys = [key for key in self.models if "local" in key]
+        sized = [key for key in local_keys if self.models[key] in self.local_model_info]
+        if sized:
+            return min(sized, key=lambda key: (parameter_billions(self.local_model_info[self.models[key]]),
+                                               self.local_model_info[self.models[key]]["size"]))
+        return local_keys[0] if local_keys else None
+
+    def search_summary_model(self):
+        """
+        检索摘要使用的小模型：SEARCH_SUMMARY_MODEL 指定的模型，否则为已安装的参数量最小的本地模型。
+        """
+        if self.search_summary_model_name:
+            return self.search_summary_model_name
+        model_key = self.smallest_local_model()
+        return self.models[model_key] if model_key else None
 
-    def generate_response(self, query, model):
+    def summarize_web_context(self, question, web_context, budget, stages, cancel_event=None):
         """
-        使用本地模型根据给定的查询和模型生成回复。
+        map-reduce 摘要：把检索内容按来源切成若干段，由小模型并行提取与问题相关的要点（map），
+        要点总量仍超出 budget 时再合并一次（reduce）。失败时退回抽取式压缩的结果（截断到预算）。
+        cancel_event 被置位时不再发出新的摘要请求并抛出 RequestCancelled。
+        """
+        model = self.search_summary_model()
+        fallback = truncate_to_tokens(web_context, budget)
+        if model is None:
+            logger.warning("没有可用于检索摘要的本地模型")
+            return fallback
+
+        sections = []
+        for block in web_context.split("\n\n"):
+            if sections and estimate_tokens(sections[-1]) + estimate_tokens(block) <= self.search_summary_chunk_tokens:
+                sections[-1] += "\n\n" + block
+            else:
+                sections.append(block)
+        note_tokens = max(budget // len(sections), 64)
+
+        parallel = threading.BoundedSemaphore(self.search_summary_parallel)
+
+        def summarize_section(section):
+            with parallel:
+                raise_if_cancelled(cancel_event)
+                return self._summarize_section(model, question, section, note_tokens)
+
+        started = time.perf_counter()
+        notes = list(self.scheduler.inner_executor.map(summarize_section, sections))
+        raise_if_cancelled(cancel_event)
+        notes = [note for note in notes if note]
+        stages[f"摘要 map（{len(sections)} 段）"] = time.perf_counter() - started
+        if not notes:
+            return fallback
+
+        summary = "\n".join(notes)
+        if estimate_tokens(summary) > budget:
+            started = time.perf_counter()
+            merged = self._summarize_section(model, question, summary, budget)
+            stages["摘要 reduce"] = time.perf_counter() - started
+            summary = merged or truncate_to_tokens(summary, budget)
+        logger.info(f"检索摘要 ({model}): 约 {estimate_tokens(web_context)} -> {estimate_tokens(summary)} tokens, "
+                    f"{', '.join(f'{name} {seconds:.2f}s' for name, seconds in stages.items())}")
+        return summary
+
+    def _summarize_section(self, model, question, text, max_tokens):
+        """
+        让小模型从 text 中提取与 question 相关的要点，保留来源编号；没有相关内容或失败时返回空字符串。
+        请求与其他本地请求共用 provider_slot 的并发配额；关闭推理（think），否则推理模型会把 token 全部用在 <think> 中。
+        """
+        prompt = (f"问题：{question}\n\n资料：\n{text}\n\n"
+                  f"请从资料中提取与问题相关的事实，用简洁的要点列出并保留来源编号（如 [1]），"
+                  f"不超过{max_tokens}字；资料与问题无关时只回复“无”。")
+        try:
+            with self.scheduler.provider_slot(f"local_{model}"):
+                response = self.ollama.post(
+                    f"{self.ollama_url}/api/chat",
+                    json={"model": model, "messages": [{"role": "user", "content": prompt}], "stream": False,
+                          "think": False,
+                          "options": {**self.ollama_options(model), "num_predict": max_tokens * 2,
+                                      "temperature": 0.2},
+                          "keep_alive": self.model_manager.keep_alive_for(model)},
+                    timeout=self.ollama_timeout,
+                )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"检索摘要失败 ({model}): {e}")
+            return ""
+        data = response.json()
+        stats = self._ollama_eval_stats(model, data)
+        self.metrics.record(model, stats["prompt_eval_count"], stats["eval_count"], None, stats["eval_duration"])
+        note = strip_think(data["message"]["content"])
+        return "" if note.strip("。. ") == "无" else note
+
+    def build_prompt(self, question, web_context=""):
+        """
+        根据给定的网络检索内容和用户问题更新并返回提示词。
         """
-        # 1. 网络检索——只有当“联网搜索”按钮处于按下状态时才进行联网搜索
-        if hasattr(self, 'search_button') and self.search_button.isChecked():
-            self.web_context += self.web_search(query)
-        
-        # 2. 更新提示词
         self.prompt_template = f"""
 [系统指令]                            
 你是一个AI助手, 当前日期为{datetime.now().strftime('%Y-%m-%d')}。
 以下是来自网络的实时信息片段(可能不完整):\n
-{self.web_context}
+{web_context}
 
 [用户问题]
-{query}
+{question}
 """
         print(self.prompt_template)
-        prompt = self.prompt_template
-        
-        # 3. 调用本地模型
-        response = requests.post(
-            "http://localhost:11434/api/generate",
+        return self.prompt_template
+
+    def generate_response(self, messages, model, on_token=None, on_stats=None, cancel_event=None):
+        """
+        使用本地模型通过 Ollama /api/chat 根据完整消息列表生成回复，请求失败时抛出异常。
+        请求经由长期复用的 self.ollama 会话发出，相同的消息前缀可以复用 Ollama 已缓存的 KV。
+        传入 on_token 时按 Ollama 的 NDJSON 流逐行解析并回调增量文本；
+        传入 on_stats 时在生成结束后回调 eval_count 等统计信息；
+        流式过程中 cancel_event 被置位时关闭连接并抛出 RequestCancelled。
+        """
+        stream = on_token is not None
+        response = self.ollama.post(
+            f"{self.ollama_url}/api/chat",
             json={
                 "model": model,
-                "prompt": prompt,
-                "stream": False,
-                "max_tokens": self.model_params['max_tokens'],
-                "temperature": self.model_params['temperature'],
-                "top_p": self.model_params['top_p'],
-                "history": self.all_messages
-            }
+                "messages": messages,
+                "stream": stream,
+                "options": self.ollama_options(model),
+                "keep_alive": self.model_manager.keep_alive_for(model),
+            },
+            stream=stream,
+            timeout=self.ollama_timeout,
         )
-        return response.json()["response"]
+        response.raise_for_status()
+        if not stream:
+            data = response.json()
+            if on_stats is not None:
+                on_stats(self._ollama_eval_stats(model, data))
+            return data["message"]["content"]
+
+        parts = []
+        if cancel_event is not None:
+            # 登记关闭函数，取消时立即断开连接，Ollama 随即停止生成
+            cancel_event.register(response.close)
+        with response:
+            try:
+                # 每行是一个独立的 JSON 对象，最后一行 done=true 携带统计信息
+                for line in response.iter_lines():
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise RequestCancelled("".join(parts))
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise RuntimeError(chunk["error"])
+                    token = chunk.get("message", {}).get("content", "")
+                    if token:
+                        parts.append(token)
+                        on_token(token)
+                    if chunk.get("done"):
+                        if on_stats is not None:
+                            on_stats(self._ollama_eval_stats(model, chunk))
+                        break
+            except Exception:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled("".join(parts))
+                raise
+        return "".join(parts)
+
+    def ollama_options(self, model):
+        """
+        Ollama 请求的生成参数。num_ctx 不同会导致模型重新加载，所有本地请求都应使用这里的结果。
+        """
+        return {
+            "num_predict": self.max_tokens_for(model),
+            "temperature": self.model_params['temperature'],
+            "top_p": self.model_params['top_p'],
+            "num_ctx": self.context_manager.window(model),
+        }
+
+    def _ollama_eval_stats(self, model, data):
+        """
+        从 Ollama 的最终响应记录中提取统计信息，时间单位由纳秒换算为秒。
+        """
+        eval_count = data.get("eval_count", 0)
+        eval_duration = data.get("eval_duration", 0) / 1e9
+        prompt_eval_duration = data.get("prompt_eval_duration", 0) / 1e9
+        stats = {
+            "model": model,
+            "eval_count": eval_count,
+            "eval_duration": eval_duration,
+            "prompt_eval_count": data.get("prompt_eval_count", 0),
+            "prompt_eval_duration": prompt_eval_duration,
+            "total_duration": data.get("total_duration", 0) / 1e9,
+            "tokens_per_second": eval_count / eval_duration if eval_duration else 0.0,
+        }
+        logger.info(f"Ollama 统计: {stats}")
+        return stats
 
     def setup_gui(self):
         """
@@ -217,9 +677,10 @@ class MultiAI(QMainWindow):
         central_widget = QWidget()
         layout = QVBoxLayout(central_widget)
 
+        # 选项文本附带本地模型的加载状态，模型名保存在选项数据中
         self.model_selector = QComboBox(self)
-        self.model_selector.addItems(self.models.keys())
-        self.model_selector.currentTextChanged.connect(self.select_model)
+        self.model_selector.currentIndexChanged.connect(
+            lambda index: self.select_model(self.model_selector.itemData(index)))
         layout.addWidget(self.model_selector)
 
         self.output_area = QTextEdit(self)
@@ -265,6 +726,23 @@ class MultiAI(QMainWindow):
         self.record_button.move(self.think_button.x() + self.think_button.width() + 5,
                                 self.entry.height() - self.record_button.height() - 5)
 
+        # 再增加一个"流式"按钮，放在"录音"按钮的右侧，按下时边生成边显示回复
+        self.stream_button = QPushButton("流式", self.entry)
+        self.stream_button.setCheckable(True)
+        self.stream_button.setChecked(True)
+        self.stream_button.setFixedSize(50, 20)
+        self.stream_button.move(self.record_button.x() + self.record_button.width() + 5,
+                                self.entry.height() - self.stream_button.height() - 5)
+
+        # 再增加一个"停止"按钮，放在"流式"按钮的右侧，点击或按 Esc 中止当前生成
+        self.stop_button = QPushButton("停止", self.entry)
+        self.stop_button.setFixedSize(50, 20)
+        self.stop_button.clicked.connect(self.stop_generation)
+        self.stop_button.move(self.stream_button.x() + self.stream_button.width() + 5,
+                              self.entry.height() - self.stop_button.height() - 5)
+        stop_shortcut = QShortcut(QKeySequence(Qt.Key.Key_Escape), self)
+        stop_shortcut.activated.connect(self.stop_generation)
+
         self.setCentralWidget(central_widget)
 
         # 添加菜单栏
@@ -273,6 +751,7 @@ class MultiAI(QMainWindow):
         dialog_menu = menubar.addMenu("对话")
         search_menu = menubar.addMenu("搜索结果")
         model_menu = menubar.addMenu('模型参数')
+        self.multi_model_menu = multi_model_menu = menubar.addMenu('多模型')
 
         load_prompt_action = QAction("加载提示词", self)
         load_prompt_action.triggered.connect(self.load_prompt_file)
@@ -302,6 +781,10 @@ class MultiAI(QMainWindow):
         show_message_action.triggered.connect(self.show_message)
         dialog_menu.addAction(show_message_action)
 
+        show_summary_action = QAction("显示上下文摘要", self)
+        show_summary_action.triggered.connect(self.show_context_summary)
+        dialog_menu.addAction(show_summary_action)
+
         show_web_context_action = QAction("显示搜索结果", self)
         show_web_context_action.triggered.connect(self.show_web_context)
         search_menu.addAction(show_web_context_action)
@@ -310,14 +793,136 @@ class MultiAI(QMainWindow):
         clear_web_context_action.triggered.connect(self.clear_web_context)
         search_menu.addAction(clear_web_context_action)
 
+        show_search_cache_action = QAction("搜索缓存统计", self)
+        show_search_cache_action.triggered.connect(self.show_search_cache)
+        search_menu.addAction(show_search_cache_action)
+
+        clear_search_cache_action = QAction("清空搜索缓存", self)
+        clear_search_cache_action.triggered.connect(self.clear_search_cache)
+        search_menu.addAction(clear_search_cache_action)
+
+        self.deep_search_action = QAction("深度搜索", self)
+        self.deep_search_action.setCheckable(True)
+        self.deep_search_action.setChecked(self.deep_search_enabled)
+        self.deep_search_action.toggled.connect(self.toggle_deep_search)
+        search_menu.addAction(self.deep_search_action)
+
+        self.search_summary_action = QAction("检索摘要", self)
+        self.search_summary_action.setCheckable(True)
+        self.search_summary_action.setChecked(self.search_summary_enabled)
+        self.search_summary_action.toggled.connect(self.toggle_search_summary)
+        search_menu.addAction(self.search_summary_action)
+
+        self.search_classifier_action = QAction("自动判断是否检索", self)
+        self.search_classifier_action.setCheckable(True)
+        self.search_classifier_action.setChecked(self.search_classifier_enabled)
+        self.search_classifier_action.toggled.connect(self.toggle_search_classifier)
+        search_menu.addAction(self.search_classifier_action)
+
+        show_search_classifier_action = QAction("检索判断统计", self)
+        show_search_classifier_action.triggered.connect(self.show_search_classifier)
+        search_menu.addAction(show_search_classifier_action)
+
         view_model_action = QAction('查看模型参数', self)
         view_model_action.triggered.connect(self.show_model)
         model_menu.addAction(view_model_action)
 
+        view_metrics_action = QAction('查看模型指标', self)
+        view_metrics_action.triggered.connect(self.show_metrics)
+        model_menu.addAction(view_metrics_action)
+
+        benchmark_action = QAction('本地模型测速', self)
+        benchmark_action.triggered.connect(self.benchmark_local_models)
+        model_menu.addAction(benchmark_action)
+
         edit_model_action = QAction('编辑模型参数', self)
         edit_model_action.triggered.connect(self.edit_model)
         model_menu.addAction(edit_model_action)
 
+        self.response_cache_action = QAction('启用回答缓存', self)
+        self.response_cache_action.setCheckable(True)
+        self.response_cache_action.toggled.connect(self.toggle_response_cache)
+        model_menu.addAction(self.response_cache_action)
+
+        clear_response_cache_action = QAction('清空回答缓存', self)
+        clear_response_cache_action.triggered.connect(self.clear_response_cache)
+        model_menu.addAction(clear_response_cache_action)
+
+        self.semantic_cache_action = QAction('启用语义缓存', self)
+        self.semantic_cache_action.setCheckable(True)
+        self.semantic_cache_action.toggled.connect(self.toggle_semantic_cache)
+        model_menu.addAction(self.semantic_cache_action)
+
+        # 多模型模式：勾选两个及以上模型后，一个问题同时发给这些模型
+        # 竞速模式：同样发给勾选的模型，但只采用最先产出的回复
+        self.fan_out_action = QAction('多模型模式', self)
+        self.fan_out_action.setCheckable(True)
+        self.race_action = QAction('竞速模式', self)
+        self.race_action.setCheckable(True)
+        mode_group = QActionGroup(self)
+        mode_group.setExclusionPolicy(QActionGroup.ExclusionPolicy.ExclusiveOptional)
+        mode_group.addAction(self.fan_out_action)
+        mode_group.addAction(self.race_action)
+        multi_model_menu.addAction(self.fan_out_action)
+        multi_model_menu.addAction(self.race_action)
+
+        hedge_delay_action = QAction('设置对冲延迟', self)
+        hedge_delay_action.triggered.connect(self.edit_hedge_delay)
+        multi_model_menu.addAction(hedge_delay_action)
+        multi_model_menu.addSeparator()
+
+        self.multi_model_actions = {}
+        self.populate_model_menus()
+
+    def populate_model_menus(self):
+        """
+        按 self.models 重建模型选择框与"多模型"菜单中的模型列表，保留仍存在模型的勾选状态。
+        """
+        self.model_selector.blockSignals(True)
+        self.model_selector.clear()
+        self.model_selector.addItem("auto（自动选择）", "auto")
+        for model_key in self.models:
+            self.model_selector.addItem(model_key, model_key)
+        self.model_selector.setCurrentIndex(max(self.model_selector.findData(self.current_model), 0))
+        self.model_selector.blockSignals(False)
+        self.refresh_model_selector()
+
+        checked = {key for key, action in self.multi_model_actions.items() if action.isChecked()}
+        for action in self.multi_model_actions.values():
+            self.multi_model_menu.removeAction(action)
+        self.multi_model_actions = {}
+        for model_key in self.models:
+            action = QAction(model_key, self)
+            action.setCheckable(True)
+            action.setChecked(model_key in checked)
+            self.multi_model_menu.addAction(action)
+            self.multi_model_actions[model_key] = action
+
+    def apply_local_models(self, installed):
+        """
+        用 Ollama 中已安装的模型替换内置的本地模型列表，并按内存与 CPU 核数选择默认本地模型。
+        installed 为 None（无法连接 Ollama）时保留内置列表。
+        """
+        if installed:
+            self.local_model_info = {info["name"]: info for info in installed}
+            local_models = {f"local_{info['name']}": info["name"] for info in installed}
+            api_models = {key: model for key, model in self.models.items() if "local" not in key}
+            self.models = {**local_models, **api_models}
+            self.clients = {**{key: None for key in local_models},
+                            **{key: client for key, client in self.clients.items() if "local" not in key}}
+            if not self.model_chosen or self.current_model not in (*self.models, "auto"):
+                default = pick_default_model(installed, available_memory(), cpu_cores())
+                if default is not None:
+                    self.current_model = f"local_{default['name']}"
+            self.populate_model_menus()
+            self.output_area_sys_message(
+                f"发现 {len(local_models)} 个本地模型，默认使用 {self.current_model}"
+                f"（可用内存 {format_bytes(available_memory())} / 共 {format_bytes(total_memory())}, "
+                f"{cpu_cores()} 核）")
+            if os.getenv("LOCAL_BENCHMARK", "0") == "1":
+                self.benchmark_local_models()
+        self.preload_model(self.current_model)
+
     def eventFilter(self, obj, event):
         # 对 self.entry 的事件处理
         if obj is self.entry:
@@ -328,20 +933,73 @@ class MultiAI(QMainWindow):
                                        self.entry.height() - self.think_button.height() - 5)
                 self.record_button.move(self.think_button.x() + self.think_button.width() + 5,
                                        self.entry.height() - self.record_button.height() - 5)
+                self.stream_button.move(self.record_button.x() + self.record_button.width() + 5,
+                                       self.entry.height() - self.stream_button.height() - 5)
+                self.stop_button.move(self.stream_button.x() + self.stream_button.width() + 5,
+                                     self.entry.height() - self.stop_button.height() - 5)
             if event.type() == QEvent.Type.KeyPress:
                 if event.key() in (Qt.Key.Key_Return, Qt.Key.Key_Enter):
                     if event.modifiers() == Qt.KeyboardModifier.ShiftModifier:
                         self.entry.insertPlainText('\n')
+                    elif event.modifiers() == Qt.KeyboardModifier.ControlModifier:
+                        # Ctrl+Enter：本条消息强制联网检索
+                        self.send_message(force_search=True)
                     else:
                         self.send_message()
                     return True
         return super().eventFilter(obj, event)
 
+    def closeEvent(self, event):
+        """
+        关闭窗口时取消正在进行的生成，释放联网搜索客户端的连接池与事件循环。
+        线程池的线程在解释器退出时会被等待，不取消的话进程要等到生成结束才能退出。
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+        self.scheduler.shutdown()
+        self.search_client.close()
+        self.page_fetcher.close()
+        self.async_loop.stop()
+        self.page_fetcher.cache.close()
+        self.search_cache.close()
+        self.response_cache.close()
+        self.semantic_cache.save()
+        self.model_state_timer.stop()
+        self.router_probe_timer.stop()
+        self.ollama.close()
+        super().closeEvent(event)
+
     def show_model(self):
         # 显示当前模型的参数
         param_str = "\n".join([f"{key}: {value}" for key, value in self.model_params.items()])
         QMessageBox.information(self, "模型参数", f"当前模型参数:\n{param_str}")
 
+    def show_metrics(self):
+        """
+        显示各模型累计的 token 用量、平均首字延迟与生成速度，以及当前对话的 token 数。
+        """
+        rows = self.metrics.snapshot()
+        dialog = QDialog(self)
+        dialog.setWindowTitle("模型指标")
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel(
+            f"当前对话: {len(self.all_messages)} 条消息, "
+            f"约 {self.token_counter.history_tokens(self.all_messages)} tokens"
+        ))
+        headers = ["模型", "请求数", "提示词 tokens", "生成 tokens", "平均首字延迟 (s)", "生成速度 (tokens/s)", "估算请求"]
+        table = QTableWidget(len(rows), len(headers), dialog)
+        table.setHorizontalHeaderLabels(headers)
+        table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        for row, metrics in enumerate(rows):
+            ttft = f"{metrics['ttft']:.2f}" if metrics["ttft"] is not None else "-"
+            values = [metrics["model"], metrics["requests"], metrics["prompt_tokens"], metrics["completion_tokens"],
+                      ttft, f"{metrics['tokens_per_second']:.1f}", metrics["estimated"]]
+            for column, value in enumerate(values):
+                table.setItem(row, column, QTableWidgetItem(str(value)))
+        layout.addWidget(table)
+        dialog.resize(760, 260)
+        dialog.exec()
+
     def edit_model(self):
         """编辑模型参数，每次创建新的对话框实例"""
         # 编辑max_tokens
@@ -352,9 +1010,12 @@ class MultiAI(QMainWindow):
             str(self.model_params['max_tokens']))
         if ok:
             try:
-                self.model_params['max_tokens'] = int(max_tokens)
+                value = int(max_tokens)
+                if value <= 0:
+                    raise ValueError
+                self.model_params['max_tokens'] = value
             except ValueError:
-                QMessageBox.warning(self, "输入无效", "请输入有效的整数")
+                QMessageBox.warning(self, "输入无效", "请输入有效的正整数")
                 return  # 输入错误时提前返回
     
         # 编辑temperature
@@ -423,6 +1084,20 @@ class MultiAI(QMainWindow):
         cursor.insertHtml(html_content)
         self.output_area.setTextCursor(cursor)
 
+    @staticmethod
+    def clean_history(messages):
+        """
+        清理旧版本保存的对话：去掉随问题一起记入历史的提示词（含检索内容），回复只保留最终答案。
+        """
+        cleaned = []
+        for message in messages:
+            if message.get("role") == "user" and message.get("content", "").lstrip().startswith("[系统指令]"):
+                continue
+            if message.get("role") == "assistant":
+                message = {**message, "content": strip_think(message.get("content", ""))}
+            cleaned.append(message)
+        return cleaned
+
     def _load_json_file(self, dialog_title, success_message, error_prefix):
         file_path, _ = QFileDialog.getOpenFileName(self, dialog_title, "", "JSON Files (*.json)")
         if file_path:
@@ -430,33 +1105,201 @@ class MultiAI(QMainWindow):
                 with open(file_path, 'r', encoding='utf-8') as file:
                     data = json.load(file)
                     if isinstance(data, list):
-                        self.all_messages = data
+                        self.context_manager.forget(self.all_messages)
+                        self.all_messages = self.clean_history(data)
+                        self.conversation_id += 1
                         self.output_area_sys_message(success_message)
+                        return file_path
                     else:
                         self.output_area_sys_message("文件内容格式错误！")
             except Exception as e:
                 self.output_area_sys_message(f"{error_prefix}{e}")
+        return None
 
-    def send_message(self):
+    def send_message(self, force_search=False):
         """
         处理用户消息发送，显示用户消息，并调用 AI 获取回复，然后显示回复。
+        force_search 为 True（Ctrl+Enter 发送）时本条消息强制联网检索。
         """
         user_message = self.entry.toPlainText().strip()
         if user_message:
-            self._insert_message_block(user_message, QColor(000, 000, 255), "white", prefix="user: ")
+            self._insert_message_block(user_message, QColor(000, 000, 255), "white",
+                                       prefix="user [强制检索]: " if force_search else "user: ")
             self.entry.clear()
-            # 异步调用 ask_question
-            self.ask_question_async(user_message)
+            multi_models = self.selected_multi_models()
+            if len(multi_models) >= 2 and self.race_action.isChecked():
+                self.race_async(user_message, multi_models, force_search)
+            elif len(multi_models) >= 2 and self.fan_out_action.isChecked():
+                self.fan_out_async(user_message, multi_models, force_search)
+            else:
+                # 异步调用 ask_question
+                self.ask_question_async(user_message, force_search)
+
+    def ask_question_async(self, question, force_search=False):
+        """
+        把 ask_question 提交给请求调度器异步执行
+        """
+        model_key = self.current_model
+        label = notice = None
+        if model_key == "auto":
+            model_key, seconds = self.route_model(question, force_search)
+            label = f"auto→{model_key}"
+            notice = f"自动路由: 选择 {model_key}（预计 {seconds:.1f}s）"
+        worker = Worker(self.ask_question, question, stream=True, stats=True, cancellable=True,
+                        model_key=model_key, history=self.all_messages, force_search=force_search)
+        self._submit_reply_worker(worker, model_key, notice=notice, label=label)
+
+    def route_model(self, question, force_search=False):
+        """
+        为 "auto" 模式选择模型：估算本轮提示词长度（历史 + 问题 + 联网检索内容），
+        排除上下文窗口放不下的模型，未加载的本地模型计入载入时间，返回 (model_key, 预计秒数)。
+        """
+        prompt_tokens = self.token_counter.history_tokens(self.all_messages) + estimate_tokens(question)
+        if force_search or (hasattr(self, 'search_button') and self.search_button.isChecked()):
+            prompt_tokens += self.web_context_tokens
+        candidates = {}
+        for model_key, model in self.models.items():
+            if self.context_manager.window(model) < prompt_tokens + self.max_tokens_for(model):
+                continue
+            loaded = "local" not in model_key or self.model_manager.state(model) == LocalModelManager.LOADED
+            candidates[model_key] = 0.0 if loaded else self.router_load_penalty
+        if not candidates:
+            # 没有窗口足够的模型时按窗口从大到小取，由上下文管理裁剪历史
+            largest = max(self.models, key=lambda key: self.context_manager.window(self.models[key]))
+            candidates[largest] = 0.0
+        model_key, seconds = self.router.choose(candidates, prompt_tokens)
+        logger.info(f"自动路由: {model_key}, 预计 {seconds:.1f}s, 提示词约 {prompt_tokens} tokens, "
+                    f"候选 {self.router.snapshot()}")
+        return model_key, seconds
+
+    def probe_models(self):
+        """
+        "auto" 模式下定期探测较久未使用的 API 模型：只请求模型列表，测量往返延迟与可用性，不消耗 token。
+        """
+        if self.current_model != "auto":
+            return
+        for model_key, client in self.clients.items():
+            if client is not None and self.router.stale(model_key, self.router_probe_interval):
+                self.scheduler.executor.submit(self._probe_model, model_key, client)
+
+    def _probe_model(self, model_key, client):
+        started = time.perf_counter()
+        try:
+            client.with_options(timeout=10).models.list()
+        except Exception as e:
+            logger.info(f"探测 {model_key} 失败: {e}")
+            self.router.record_probe(model_key, None)
+            return
+        self.router.record_probe(model_key, time.perf_counter() - started)
 
-    def ask_question_async(self, question):
+    def _submit_reply_worker(self, worker, model_key, notice=None, label=None):
+        """
+        提交一个以普通回复方式显示结果的任务。任务真正开始执行时才切换当前回复状态，
+        因此排队中的任务不会打断正在显示的回复。label 为回复标题中显示的模型名，默认为 model_key。
+        """
+        stream_display = hasattr(self, 'stream_button') and self.stream_button.isChecked()
+
+        def begin():
+            if notice:
+                self.output_area_sys_message(notice)
+            self.worker = worker
+            self.stream_display = stream_display
+            self.stream_text = ""
+            self.stream_shown = ""
+            self.stream_cursor = None
+            self.pending_stats = None
+            self.reply_model = label or model_key
+
+        worker.started_signal.connect(begin)
+        worker.token_signal.connect(self.handle_token)
+        worker.stats_signal.connect(self.handle_stats)
+        worker.result_signal.connect(self.handle_answer)
+        self.scheduler.submit(worker, self.conversation_id)
+
+    def update_queue_status(self):
         """
-        异步调用 ask_question 方法
+        在状态栏显示请求队列深度、运行数和平均排队时间。
         """
-        self.worker = Worker(self.ask_question, question)
-        self.worker.result_signal.connect(self.handle_answer)
-        self.worker.start()
+        stats = self.scheduler.stats()
+        self.statusBar().showMessage(
+            f"请求队列: 排队 {stats['queued']} | 运行 {stats['running']} | "
+            f"等待模型并发配额 {stats['waiting_for_slot']} | 平均排队 {stats['avg_wait']:.1f}s"
+        )
+
+    def handle_token(self, delta):
+        """
+        接收 Worker 推送的增量文本；开启流式显示时追加到当前回复块中。
+        """
+        self.stream_text += delta
+        if not self.stream_display:
+            return
+        visible = self._visible_stream_text(self.stream_text)
+        if not visible.startswith(self.stream_shown) or visible == self.stream_shown:
+            return
+        if self.stream_cursor is None:
+            # 收到第一个可见 token 时才创建回复块，记录起始位置以便结束后替换
+            self.stream_start = self.output_area.textCursor().position()
+            self._insert_message_block("", QColor(000, 240, 000), "black",
+                                       prefix=self.reply_model + " REPLY\n")
+            self.stream_cursor = QTextCursor(self.output_area.textCursor())
+        self.stream_cursor.insertText(visible[len(self.stream_shown):])
+        self.stream_shown = visible
+        self.output_area.ensureCursorVisible()
+
+    def handle_stats(self, stats):
+        """
+        暂存本次请求的生成统计，待回复块显示后再输出；竞速模式下据此更新回复模型。
+        """
+        self.pending_stats = {**(self.pending_stats or {}), **stats}
+        if "winner" in stats:
+            self.reply_model = stats["winner"]
+
+    def _visible_stream_text(self, text):
+        """
+        计算流式预览中应显示的文本：未按下"推理"按钮时隐藏 <think> 段，
+        并暂缓显示可能是 <think> 标签开头的尾部字符，避免标签被拆开显示。
+        """
+        if hasattr(self, 'think_button') and self.think_button.isChecked():
+            return text
+        visible = re.sub(r'<think>.*?(</think>|$)', '', text, flags=re.IGNORECASE | re.DOTALL)
+        partial = re.search(r'<[^<>]*$', visible)
+        if partial and '<think>'.startswith(partial.group().lower()):
+            visible = visible[:partial.start()]
+        return visible.lstrip()
+
+    def _end_stream_block(self):
+        """
+        删除流式预览块，之后由 handle_answer 以完整格式重新插入推理与回复内容。
+        """
+        if self.stream_cursor is None:
+            return
+        cursor = self.output_area.textCursor()
+        cursor.setPosition(self.stream_start)
+        cursor.setPosition(self.stream_cursor.position(), QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        self.output_area.setTextCursor(cursor)
+        self.stream_cursor = None
 
     def handle_answer(self, ai_response):
+        self._end_stream_block()
+        stats = self.pending_stats or {}
+        self.pending_stats = None
+        if stats.get("cached") == "semantic":
+            reply_tag = f" REPLY [语义缓存 相似度 {stats['similarity']:.2f}]\n"
+        elif stats.get("cached"):
+            reply_tag = " REPLY [缓存]\n"
+        elif stats.get("cancelled"):
+            reply_tag = " REPLY [已中断]\n"
+        elif stats.get("winner"):
+            reply_tag = " REPLY [竞速胜出]\n"
+        else:
+            reply_tag = " REPLY\n"
+        self._render_answer(self.reply_model, ai_response, reply_tag, stats)
+
+    def _render_answer(self, model_label, ai_response, reply_tag, stats, speak=True):
+        """
+        显示一条模型回复：按需显示推理块、回复块与本地模型生成统计，并按需朗读。
+        """
         # 拆分回复中的 <think> 部分和其他部分
         parts = re.split(r'(<think>.*?</think>)', ai_response, flags=re.IGNORECASE | re.DOTALL)
         think_content = ""
@@ -469,64 +1312,679 @@ class MultiAI(QMainWindow):
         # 仅当“推理”按钮处于按下状态且 think_content 存在时显示推理内容
         if think_content and hasattr(self, 'think_button') and self.think_button.isChecked():
             self._insert_message_block(think_content, QColor(240, 240, 240), "grey",
-                                       prefix=self.current_model + " THINK\n")
+                                       prefix=model_label + " THINK\n")
 
         if ai_response:
             self._insert_message_block(ai_response, QColor(000, 240, 000), "black",
-                                       prefix=self.current_model + " REPLY\n")
+                                       prefix=model_label + reply_tag)
             # 仅当录音按钮被按下时生成语音
-            if hasattr(self, 'record_button') and self.record_button.isChecked():
+            if speak and hasattr(self, 'record_button') and self.record_button.isChecked():
                 self.text_to_speech(ai_response)
 
-    def ask_question(self, question):
+        if "eval_count" in stats:
+            self.output_area_sys_message(
+                f"{stats['model']} 生成 {stats['eval_count']} tokens, "
+                f"{stats['tokens_per_second']:.1f} tokens/s; "
+                f"提示词评估 {stats['prompt_eval_count']} tokens, 用时 {stats['prompt_eval_duration']:.2f}s"
+            )
+        elif "completion_tokens" in stats:
+            ttft = f"首字 {stats['ttft']:.2f}s, " if stats["ttft"] is not None else ""
+            estimated = "（估算）" if stats["estimated"] else ""
+            self.output_area_sys_message(
+                f"{stats['model']} 提示词 {stats['prompt_tokens']} tokens, 生成 {stats['completion_tokens']} tokens"
+                f"{estimated}; {ttft}{stats['tokens_per_second']:.1f} tokens/s"
+            )
+        if "stages" in stats:
+            self.output_area_sys_message(
+                "各阶段耗时: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in stats["stages"].items()))
+
+    def selected_multi_models(self):
         """
-        向当前选定的 AI 模型提问，并返回模型回复。
+        返回"多模型"菜单中勾选的模型列表，当前选定的模型排在最前（竞速模式下作为主模型）。
         """
-        self.all_messages.append({"role": "user", "content": question})
-        if "local" in self.current_model:
-            model = self.models[self.current_model]
-            answer = self.generate_response(question, model)
-            self.all_messages.append({"role": "assistant", "content": answer})
-            return answer
-        else:
-            # 仅当“联网搜索”按钮处于按下状态时进行联网检索
-            if hasattr(self, 'search_button') and self.search_button.isChecked():
-                self.web_context += self.web_search(question)
-            self.prompt_template = f"""
-[系统指令]                            
-你是一个AI助手, 当前日期为{datetime.now().strftime('%Y-%m-%d')}。
-以下是来自网络的实时信息片段(可能不完整):\n
-{self.web_context}
+        model_keys = [key for key, action in self.multi_model_actions.items() if action.isChecked()]
+        if self.current_model in model_keys:
+            model_keys.remove(self.current_model)
+            model_keys.insert(0, self.current_model)
+        return model_keys
 
-[用户问题]
-{question}
-"""
-            print(self.prompt_template)
+    def fan_out_async(self, question, model_keys, force_search=False):
+        """
+        把 fan_out_question 提交给请求调度器，各模型的回复完成一个显示一个。
+        """
+        worker = Worker(self.fan_out_question, question, model_keys, replies=True, cancellable=True,
+                        history=self.all_messages, force_search=force_search)
+
+        def begin():
+            self.output_area_sys_message(f"多模型提问: {', '.join(model_keys)}")
+            self.worker = worker
+            self.stream_text = ""
+            self.stream_cursor = None
+
+        worker.started_signal.connect(begin)
+        worker.reply_signal.connect(self.handle_fan_out_reply)
+        worker.result_signal.connect(self.output_area_sys_message)
+        self.scheduler.submit(worker, self.conversation_id)
+
+    def race_async(self, question, model_keys, force_search=False):
+        """
+        把 race_question 提交给请求调度器，胜出模型的回复按普通回复方式显示。
+        """
+        delay = f"，对冲延迟 {self.hedge_delay_ms}ms" if self.hedge_delay_ms else ""
+        worker = Worker(self.race_question, question, model_keys, stream=True, stats=True,
+                        cancellable=True, history=self.all_messages, hedge_delay_ms=self.hedge_delay_ms,
+                        force_search=force_search)
+        self._submit_reply_worker(worker, model_keys[0],
+                                  notice=f"竞速提问: {', '.join(model_keys)}{delay}")
+
+    def edit_hedge_delay(self):
+        delay, ok = QInputDialog.getInt(self, "竞速模式", "对冲延迟 (毫秒，0 表示同时发出):",
+                                        self.hedge_delay_ms, 0, 60000, 100)
+        if ok:
+            self.hedge_delay_ms = delay
+            self.output_area_sys_message(f"对冲延迟已设置为 {delay}ms")
 
-            self.all_messages.append({"role": "user", "content": self.prompt_template})
-            client = self.clients[self.current_model]
-            model = self.models[self.current_model]
+    def stop_generation(self):
+        """
+        停止当前生成：取消令牌会立即断开 HTTP 流，任务从 GUI 上解绑，
+        已收到的部分回复立即显示，并由任务线程记入对话历史。排队中的任务不受影响；
+        任务阻塞在模型加载或无响应的请求上时，调度器让出对话队列，后续任务不必等待它超时。
+        """
+        worker = self.worker
+        if worker is None or worker.done:
+            return
+        self.scheduler.cancel(worker)
+        for signal in (worker.token_signal, worker.stats_signal, worker.reply_signal, worker.result_signal):
             try:
-                response = client.chat.completions.create(
-                    model = model,
-                    messages = self.all_messages,
-                    max_tokens = self.model_params['max_tokens'],
-                    temperature = self.model_params['temperature'],
-                    top_p = self.model_params['top_p'],
-                    stream=False,
-                )
-                answer = response.choices[0].message.content
-                self.all_messages.append({"role": "assistant", "content": answer})
+                signal.disconnect()
+            except TypeError:
+                pass
+        self.worker = None
+
+        partial = self.stream_text
+        if partial.lower().count("<think>") > partial.lower().count("</think>"):
+            partial += "</think>"
+        self.output_area_sys_message("已停止生成")
+        if partial.strip():
+            self.pending_stats = {**(self.pending_stats or {}), "cancelled": True}
+            self.handle_answer(partial)
+        else:
+            self._end_stream_block()
+
+    def handle_fan_out_reply(self, reply):
+        """
+        显示多模型模式下单个模型的回复，标题中附带该模型的耗时。
+        """
+        stats = reply["stats"]
+        if stats.get("cancelled"):
+            reply_tag = f" REPLY [已中断] ({reply['latency']:.1f}s)\n"
+        elif stats.get("cached"):
+            reply_tag = f" REPLY [缓存] ({reply['latency']:.1f}s)\n"
+        else:
+            reply_tag = f" REPLY ({reply['latency']:.1f}s)\n"
+        self._render_answer(reply["model_key"], reply["answer"], reply_tag, stats, speak=False)
+
+    def ask_question(self, question, model_key=None, history=None, on_token=None, on_stats=None,
+                     cancel_event=None, force_search=False):
+        """
+        向 model_key（默认为当前选定的模型）提问，并返回模型回复。
+        history 为提交时所属的对话消息列表（默认为当前对话），清除或加载对话不影响排队中的请求。
+        请求总是以流式方式发出，on_token 用于回调每段增量文本，on_stats 用于回传生成统计。
+        cancel_event 被置位时中止请求，并把已生成的部分回复记入对话历史。
+        """
+        model_key = model_key or self.current_model
+        if history is None:
+            history = self.all_messages
+        history.append({"role": "user", "content": question})
+        stages = {}
+        search = self.should_search(question, force_search, stages)
+        # 语义缓存只用于对话的第一个问题，避免忽略上下文而答非所问；
+        # 需要联网检索的问题有时效性，不查也不存语义缓存
+        semantic_vector = None
+        if self.semantic_cache_enabled and len(history) == 2 and not search:
+            answer, similarity, semantic_vector = self.semantic_cache.lookup(model_key, question)
+            if answer is not None:
+                logger.info(f"语义缓存命中: {model_key} 相似度 {similarity:.3f}")
+                if on_stats is not None:
+                    on_stats({"model": self.models[model_key], "cached": "semantic",
+                              "similarity": similarity})
+                self.record_answer(history, answer, model_key)
                 return answer
+
+        try:
+            prompt = self.prepare_prompt(question, [model_key], on_stats, force_search, cancel_event,
+                                         search=search, stages=stages)
+            messages = self.fit_context(model_key, history, {"role": "user", "content": prompt})
+            answer = self.query_model(model_key, messages,
+                                      on_token=on_token or _ignore_token, on_stats=on_stats,
+                                      cancel_event=cancel_event)
+        except RequestCancelled as e:
+            partial = e.args[0]
+            logger.info(f"{model_key} 生成已中断，保留 {len(partial)} 个字符")
+            if partial:
+                self.record_answer(history, partial, model_key)
+            return partial
+        except Exception as e:
+            return self.request_error_message(model_key, e)
+        self.record_answer(history, answer, model_key)
+        if semantic_vector is not None:
+            self.semantic_cache.add(model_key, question, answer, semantic_vector)
+        return answer
+
+    def query_model(self, model_key, messages, on_token=None, on_stats=None, cancel_event=None, model=None):
+        """
+        向 model_key 对应的模型发送一次请求并返回回复，不修改对话历史，失败时抛出异常。
+        messages 的最后一条为本轮请求，本地模型与 API 模型都发送完整的消息列表。
+        只有流式请求（传入 on_token）可以通过 cancel_event 中途取消。
+        model 可以替换为同一提供方的其他模型（如摘要用的廉价模型），此时不更新自动路由的统计。
+        """
+        model = model or self.models[model_key]
+        cache_key = self.response_cache_key(model_key, model, messages)
+        cached = self.lookup_response_cache(cache_key, model, on_stats)
+        if cached is not None:
+            return cached
+
+        usage = {}
+        timing = {}
+
+        def timed_token(token):
+            timing.setdefault("first_token", time.perf_counter())
+            on_token(token)
+
+        def collect_stats(stats):
+            usage.update(stats)
+            if on_stats is not None:
+                on_stats(stats)
+
+        # 按模型提供方限制并发，排队期间被取消则直接放弃
+        try:
+            with self.scheduler.provider_slot(model_key):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled("")
+                timing["started"] = time.perf_counter()
+                if "local" in model_key:
+                    self.last_local_model = model_key
+                    answer = self.generate_response(messages, model,
+                                                    on_token=timed_token if on_token is not None else None,
+                                                    on_stats=collect_stats, cancel_event=cancel_event)
+                    self.model_manager.mark_loaded(model)
+                elif on_token is not None:
+                    answer = self._stream_chat_completion(self.clients[model_key], model, messages, timed_token,
+                                                          cancel_event=cancel_event, on_usage=usage.update)
+                else:
+                    response = self.clients[model_key].chat.completions.create(
+                        model = model,
+                        messages = messages,
+                        max_tokens = self.max_tokens_for(model),
+                        temperature = self.model_params['temperature'],
+                        top_p = self.model_params['top_p'],
+                        stream=False,
+                    )
+                    answer = response.choices[0].message.content
+                    if response.usage is not None:
+                        usage.update(prompt_tokens=response.usage.prompt_tokens,
+                                     completion_tokens=response.usage.completion_tokens)
+        except RequestCancelled:
+            raise
+        except Exception:
+            if model == self.models[model_key]:
+                self.router.record_error(model_key)
+            raise
+        self.record_metrics(model_key, messages, answer, usage, timing, on_stats, model)
+        self.store_response_cache(cache_key, answer)
+        return answer
+
+    def record_metrics(self, model_key, messages, answer, usage, timing, on_stats=None, model=None):
+        """
+        记录一次请求的 token 用量、首字延迟与生成速度，并更新自动路由的延迟统计。
+        优先使用 Ollama 的评估统计或接口返回的 usage，两者都没有时按消息估算。
+        model 不是 model_key 的模型时（同一提供方的其他模型）只记录用量，不更新路由统计。
+        """
+        model = model or self.models[model_key]
+        finished = time.perf_counter()
+        first_token = timing.get("first_token")
+        ttft = first_token - timing["started"] if first_token is not None else None
+        if "eval_count" in usage:
+            prompt_tokens = usage["prompt_eval_count"]
+            completion_tokens = usage["eval_count"]
+            generation_time = usage["eval_duration"]
+            estimated = False
+        else:
+            estimated = "completion_tokens" not in usage
+            if estimated:
+                prompt_tokens = sum(self.token_counter.message_tokens(message) for message in messages)
+                completion_tokens = estimate_tokens(answer)
+            else:
+                prompt_tokens = usage["prompt_tokens"]
+                completion_tokens = usage["completion_tokens"]
+            generation_time = finished - (first_token or timing["started"])
+        self.metrics.record(model, prompt_tokens, completion_tokens, ttft, generation_time, estimated)
+        tokens_per_second = completion_tokens / generation_time if generation_time > 0 else 0.0
+        if model == self.models[model_key]:
+            self.router.record(model_key, finished - timing["started"] if ttft is None else ttft,
+                               tokens_per_second, prompt_tokens)
+        # Ollama 的统计已由 generate_response 回传，这里只为 API 模型补充
+        if on_stats is not None and "eval_count" not in usage:
+            on_stats({
+                "model": model,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "ttft": ttft,
+                "tokens_per_second": tokens_per_second,
+                "estimated": estimated,
+            })
+
+    def fit_context(self, model_key, history, request):
+        """
+        按 model_key 的上下文窗口裁剪要发送的消息。
+        request 为本轮实际发送的用户消息（附带检索内容的提示词），替换 history 末尾的原始问题。
+        """
+        model = self.models[model_key]
+        return self.context_manager.build(history, model, self.max_tokens_for(model), request)
+
+    def max_tokens_for(self, model):
+        """
+        model 单次生成的 token 上限：max_tokens 参数，但不超过上下文窗口的一半，为提示词留出空间。
+        """
+        return self.context_manager.output_limit(model, self.model_params['max_tokens'])
+
+    def record_answer(self, history, answer, model_key):
+        """
+        把 model_key 的回复记入对话历史：只保留最终答案，推理过程（<think>）只用于显示，不再随后续请求重发。
+        """
+        history.append({"role": "assistant", "content": strip_think(answer)})
+        self.schedule_context_summary(history, model_key)
+
+    def model_available(self, model_key):
+        """
+        model_key 是否可用：本地模型总是可用，API 模型需要配置了 API key。
+        """
+        if model_key not in self.models:
+            return False
+        client = self.clients.get(model_key)
+        return "local" in model_key or (client is not None and bool(client.api_key))
+
+    def context_summary_model(self, model_key):
+        """
+        选择折叠 model_key 所在对话的摘要模型：优先使用 SUMMARY_MODEL；否则本地对话用参数量最小的本地模型，
+        API 对话用同一个模型，避免把只在本地进行的对话发往第三方。没有可用的模型时返回 None。
+        """
+        if self.summary_model:
+            return self.summary_model if self.model_available(self.summary_model) else None
+        if "local" in model_key:
+            return self.smallest_local_model()
+        return model_key if self.model_available(model_key) else None
+
+    def schedule_context_summary(self, history, model_key):
+        """
+        较早的对话轮次超过保留数量时，在后台用廉价模型把它们折叠进滚动摘要；没有可用的摘要模型时不折叠。
+        API 提供方在 summary_cheap_models 中配置了廉价模型时，经同一客户端改用该模型。
+        """
+        summary_model = self.context_summary_model(model_key)
+        if summary_model is None:
+            return
+        model = self.summary_cheap_models.get(summary_model) if "local" not in summary_model else None
+        fold = self.context_manager.claim_fold(history)
+        if fold is None:
+            return
+
+        def summarize():
+            prompt = self.context_manager.summary_prompt(history, fold)
+            messages = [{"role": "system", "content": "你是一个对话摘要助手。"},
+                        {"role": "user", "content": prompt}]
+            try:
+                summary = self.query_model(summary_model, messages, on_token=_ignore_token, model=model)
+            except Exception as e:
+                logger.warning(f"生成对话摘要失败: {e}")
+                self.context_manager.release_fold(history)
+                return
+            summary = strip_think(summary)
+            self.context_manager.apply_fold(history, fold, summary)
+            logger.info(f"{model or self.models[summary_model]} 已将前 {fold} 条消息折叠为摘要"
+                        f"（{estimate_tokens(summary)} tokens）")
+
+        self.scheduler.executor.submit(summarize)
+
+    def request_error_message(self, model_key, error):
+        """
+        生成请求失败时展示给用户的提示文本。
+        """
+        if "local" in model_key:
+            logger.error(f"本地模型请求失败: {error}")
+            return f"本地模型请求失败: {str(error)}"
+        logger.error(f"API请求失败: {error}")
+        return f"API请求失败: {str(error)}"
+
+    def fan_out_question(self, question, model_keys, history=None, on_reply=None, cancel_event=None,
+                         force_search=False):
+        """
+        多模型模式：把同一个问题并发发送给 model_keys 中的每个模型，
+        每个模型完成时通过 on_reply 回调其回复与耗时，总耗时取决于最慢的模型。
+        对话历史只记录问题以及主模型（model_keys[0]，失败时为最先成功的模型）的回复。
+        """
+        if history is None:
+            history = self.all_messages
+        history.append({"role": "user", "content": question})
+        try:
+            prompt = self.prepare_prompt(question, model_keys, force_search=force_search, cancel_event=cancel_event)
+        except RequestCancelled:
+            logger.info("多模型提问在准备提示词时已中断")
+            return ""
+        prompt_message = {"role": "user", "content": prompt}
+
+        def run(model_key):
+            stats = {}
+            started = time.perf_counter()
+            messages = self.fit_context(model_key, history, prompt_message)
+            try:
+                answer = self.query_model(model_key, messages, on_token=_ignore_token,
+                                          on_stats=stats.update, cancel_event=cancel_event)
+                ok = True
+            except RequestCancelled as e:
+                answer = e.args[0]
+                ok = bool(answer)
+                stats["cancelled"] = True
             except Exception as e:
-                return f"API请求失败: {str(e)}"
+                answer = self.request_error_message(model_key, e)
+                ok = False
+            return {"model_key": model_key, "answer": answer, "ok": ok,
+                    "latency": time.perf_counter() - started, "stats": stats}
+
+        started = time.perf_counter()
+        replies = {}
+        futures = [self.scheduler.inner_executor.submit(run, model_key) for model_key in model_keys]
+        for future in as_completed(futures):
+            reply = future.result()
+            replies[reply["model_key"]] = reply
+            if on_reply is not None:
+                on_reply(reply)
+
+        successful = [reply for reply in replies.values() if reply["ok"]]
+        primary = replies.get(model_keys[0])
+        if primary is None or not primary["ok"]:
+            primary = min(successful, key=lambda reply: reply["latency"], default=None)
+        if primary is not None:
+            self.record_answer(history, primary["answer"], primary["model_key"])
+        slowest = max(replies.values(), key=lambda reply: reply["latency"])
+        return (f"多模型完成: {len(successful)}/{len(model_keys)} 个模型成功, "
+                f"总用时 {time.perf_counter() - started:.1f}s（最慢 {slowest['model_key']} "
+                f"{slowest['latency']:.1f}s）")
+
+    def response_cache_key(self, provider, model, messages):
+        """
+        由模型提供方、模型名、完整消息列表和采样参数计算回答缓存键。
+        提示词中的日期每天变化，计算键时将其忽略，使每日重放的相同问题也能命中。
+        """
+        normalized = [
+            {**message, "content": re.sub(r'当前日期为\d{4}-\d{2}-\d{2}', '当前日期为', message["content"])}
+            for message in messages
+        ]
+        payload = json.dumps(
+            {"provider": provider, "model": model, "messages": normalized, "params": self.model_params},
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup_response_cache(self, cache_key, model, on_stats=None):
+        """
+        回答缓存开启时查找缓存，命中后通过 on_stats 标记本次回复来自缓存。
+        """
+        if not self.response_cache_enabled:
+            return None
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"回答缓存命中: {model} {cache_key[:12]}")
+            if on_stats is not None:
+                on_stats({"model": model, "cached": "exact"})
+        return cached
+
+    def store_response_cache(self, cache_key, answer):
+        if self.response_cache_enabled and answer:
+            self.response_cache.set(cache_key, answer)
+
+    def race_question(self, question, model_keys, history=None, on_token=None, on_stats=None,
+                      hedge_delay_ms=0, cancel_event=None, force_search=False):
+        """
+        竞速模式：把同一个问题发给多个模型，采用最先产出的回复并取消其余请求。
+        请求总是以流式方式发出（"流式"按钮只影响显示），因此以第一个 token 判定胜负；
+        命中回答缓存等不产出 token 的回复按完成先后判定。
+        hedge_delay_ms 大于 0 时先只请求主模型（model_keys[0]），
+        若其在该时间内仍未产出内容才启动备用模型。
+        cancel_event 被置位时中止全部请求，并记录胜出模型已生成的部分回复。
+        """
+        if history is None:
+            history = self.all_messages
+        history.append({"role": "user", "content": question})
+        try:
+            prompt = self.prepare_prompt(question, model_keys, on_stats, force_search, cancel_event)
+        except RequestCancelled:
+            logger.info("竞速提问在准备提示词时已中断")
+            return ""
+        prompt_message = {"role": "user", "content": prompt}
+
+        lock = threading.Lock()
+        first_token = threading.Event()
+        cancel_events = {model_key: CancelToken() for model_key in model_keys}
+        state = {"winner": None}
+        winner_parts = []
+        started = time.perf_counter()
+
+        def claim(model_key):
+            # 第一个产出内容的模型胜出，同时取消其余模型的请求
+            with lock:
+                if state["winner"] is None:
+                    state["winner"] = model_key
+                    for key, event in cancel_events.items():
+                        if key != model_key:
+                            event.set()
+                    logger.info(f"竞速胜出: {model_key} {time.perf_counter() - started:.2f}s")
+                    if on_stats is not None:
+                        on_stats({"model": self.models[model_key], "winner": model_key})
+                return state["winner"] == model_key
+
+        def run(model_key):
+            def forward_token(token):
+                # 非流式显示时仍以流式请求，保证落败的请求可以被取消
+                first_token.set()
+                if claim(model_key):
+                    winner_parts.append(token)
+                    if on_token is not None:
+                        on_token(token)
+
+            def forward_stats(stats):
+                if state["winner"] == model_key and on_stats is not None:
+                    on_stats(stats)
+
+            messages = self.fit_context(model_key, history, prompt_message)
+            return self.query_model(model_key, messages, on_token=forward_token,
+                                    on_stats=forward_stats, cancel_event=cancel_events[model_key])
+
+        executor = self.scheduler.inner_executor
+        primary = executor.submit(run, model_keys[0])
+        futures = {primary: model_keys[0]}
+        if hedge_delay_ms > 0:
+            deadline = started + hedge_delay_ms / 1000
+            while (not first_token.is_set() and not primary.done() and time.perf_counter() < deadline
+                   and not (cancel_event is not None and cancel_event.is_set())):
+                first_token.wait(0.02)
+        primary_succeeded = primary.done() and primary.exception() is None
+        if not first_token.is_set() and not primary_succeeded:
+            for model_key in model_keys[1:]:
+                futures[executor.submit(run, model_key)] = model_key
+
+        answer = None
+        errors = []
+        try:
+            pending = set(futures)
+            while pending and answer is None:
+                if cancel_event is not None and cancel_event.is_set():
+                    for event in cancel_events.values():
+                        event.set()
+                    partial = "".join(winner_parts)
+                    if partial:
+                        self.record_answer(history, partial, state["winner"])
+                    return partial
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model_key = futures[future]
+                    try:
+                        result = future.result()
+                    except RequestCancelled:
+                        continue
+                    except Exception as e:
+                        errors.append(self.request_error_message(model_key, e))
+                        if state["winner"] == model_key:
+                            return errors[-1]
+                        continue
+                    if claim(model_key):
+                        answer = result
+        finally:
+            for event in cancel_events.values():
+                if state["winner"] is not None:
+                    event.set()
+
+        if answer is None:
+            return "\n".join(errors) or "竞速模式没有得到任何回复"
+        self.record_answer(history, answer, state["winner"])
+        return answer
+
+    def _stream_chat_completion(self, client, model, messages, on_token, cancel_event=None, on_usage=None):
+        """
+        以 stream=True 调用 OpenAI 兼容接口，逐段回调增量文本并返回完整回复。
+        cancel_event 被置位时关闭流并抛出 RequestCancelled。
+        接口在流末尾返回 usage 时通过 on_usage 回传 prompt_tokens 与 completion_tokens。
+        """
+        stream = client.chat.completions.create(
+            model = model,
+            messages = messages,
+            max_tokens = self.max_tokens_for(model),
+            temperature = self.model_params['temperature'],
+            top_p = self.model_params['top_p'],
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parts = []
+        if cancel_event is not None:
+            # 登记关闭函数，取消时立即断开连接，不必等到下一个数据块
+            cancel_event.register(stream.close)
+        try:
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise RequestCancelled("".join(parts))
+                # 部分服务商把 usage 放在最后一个 choice 中而不是数据块顶层
+                usage = getattr(chunk, "usage", None) or (
+                    getattr(chunk.choices[0], "usage", None) if chunk.choices else None)
+                if usage and on_usage is not None:
+                    if isinstance(usage, dict):
+                        on_usage({"prompt_tokens": usage.get("prompt_tokens", 0),
+                                  "completion_tokens": usage.get("completion_tokens", 0)})
+                    else:
+                        on_usage({"prompt_tokens": usage.prompt_tokens,
+                                  "completion_tokens": usage.completion_tokens})
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    on_token(delta)
+        except Exception:
+            if cancel_event is not None and cancel_event.is_set():
+                stream.close()
+                raise RequestCancelled("".join(parts))
+            raise
+        return "".join(parts)
 
     def select_model(self, model):
         """
         根据用户选择更新当前使用的模型。
         """
         self.current_model = model
+        self.model_chosen = True
         self.output_area_sys_message(f"已切换到 {model} 模型\n")
+        self.preload_model(model)
+
+    def benchmark_local_models(self):
+        """
+        在后台对可用内存放得下的本地模型做一次短生成测速，完成后按 tokens/s 排序；
+        内存未知时只测最小的模型。
+        """
+        ram = available_memory()
+        model_keys = [key for key, model in self.models.items() if "local" in key
+                      and fits_memory(self.local_model_info.get(model), ram)]
+        if not model_keys and ram is None and self.smallest_local_model() is not None:
+            model_keys = [self.smallest_local_model()]
+        if not model_keys:
+            self.output_area_sys_message("没有可测速的本地模型")
+            return
+        self.output_area_sys_message(f"本地模型测速: {', '.join(model_keys)}")
+        self.scheduler.executor.submit(lambda: self.benchmark_signal.emit(self.run_local_benchmark(model_keys)))
+
+    def run_local_benchmark(self, model_keys):
+        """
+        依次让每个模型生成约 32 个 token，返回 {model_key: tokens/s}，失败的模型不在结果中。
+        """
+        results = {}
+        for model_key in model_keys:
+            model = self.models[model_key]
+            messages = [{"role": "user", "content": "用一句话介绍你自己。"}]
+            try:
+                with self.scheduler.provider_slot(model_key):
+                    response = self.ollama.post(
+                        f"{self.ollama_url}/api/chat",
+                        json={"model": model, "messages": messages, "stream": False,
+                              "options": {**self.ollama_options(model), "num_predict": 32},
+                              "keep_alive": self.model_manager.keep_alive_for(model)},
+                        timeout=self.ollama_timeout,
+                    )
+                    response.raise_for_status()
+            except Exception as e:
+                logger.warning(f"{model} 测速失败: {e}")
+                continue
+            stats = self._ollama_eval_stats(model, response.json())
+            self.metrics.record(model, stats["prompt_eval_count"], stats["eval_count"], None, stats["eval_duration"])
+            self.model_manager.mark_loaded(model)
+            results[model_key] = stats["tokens_per_second"]
+        return results
+
+    def show_local_benchmark(self, results):
+        """
+        显示测速结果，并把本地模型按生成速度从快到慢排列在模型列表中。
+        """
+        if not results:
+            self.output_area_sys_message("本地模型测速失败")
+            return
+        ranking = sorted(results.items(), key=lambda item: item[1], reverse=True)
+        self.output_area_sys_message("本地模型测速结果:\n" + "\n".join(
+            f"{rank}. {model_key}: {speed:.1f} tokens/s" for rank, (model_key, speed) in enumerate(ranking, 1)))
+        order = {model_key: rank for rank, (model_key, _) in enumerate(ranking)}
+        local_keys = sorted((key for key in self.models if "local" in key),
+                            key=lambda key: order.get(key, len(order)))
+        self.models = {**{key: self.models[key] for key in local_keys},
+                       **{key: model for key, model in self.models.items() if "local" not in key}}
+        self.populate_model_menus()
+
+    def preload_model(self, model_key):
+        """
+        在后台预加载本地模型，使首次提问不必等待模型载入。
+        """
+        if "local" not in model_key:
+            return
+        model = self.models[model_key]
+        self.scheduler.executor.submit(self.model_manager.preload, model, self.ollama_options(model))
+
+    def poll_model_states(self):
+        local_models = [model for key, model in self.models.items() if "local" in key]
+        self.scheduler.executor.submit(self.model_manager.refresh, local_models)
+
+    def refresh_model_selector(self):
+        """
+        在模型选择框中显示本地模型的加载状态。
+        """
+        for index in range(self.model_selector.count()):
+            model_key = self.model_selector.itemData(index)
+            if "local" in model_key:
+                state = self.model_manager.state(self.models[model_key])
+                self.model_selector.setItemText(index, f"{model_key}（{state}）")
 
     def text_to_speech(self, text):
         """
@@ -544,11 +2002,14 @@ class MultiAI(QMainWindow):
             except Exception as e:
                 logger.error(f"语音生成失败: {str(e)}")
 
-        # 在Qt事件循环中运行异步任务
-        try:
-            asyncio.run(async_tts())
-        except RuntimeError:
-            print("Event loop is already running.")
+        # 提交到后台事件循环执行，不阻塞 GUI 线程
+        self.run_async(async_tts())
+
+    def run_async(self, coro):
+        """
+        把协程提交到应用共用的后台事件循环，返回 concurrent.futures.Future。
+        """
+        return self.async_loop.submit(coro)
 
     def handle_playback_error(self, error_msg):
         """处理播放错误"""
@@ -584,7 +2045,66 @@ class MultiAI(QMainWindow):
                 self.output_area_sys_message(f"保存提示词失败: {e}")
 
     def load_message(self):
-        self._load_json_file("加载对话", "成功加载对话！", "加载对话失败: ")
+        file_path = self._load_json_file("加载对话", "成功加载对话！", "加载对话失败: ")
+        if file_path:
+            self.restore_local_context(file_path)
+
+    @staticmethod
+    def local_context_path(file_path):
+        return os.path.splitext(file_path)[0] + ".ollama.json"
+
+    def save_local_context(self, file_path):
+        """
+        在对话文件旁保存恢复本地模型上下文所需的信息：最近使用的本地模型与滚动摘要。
+        """
+        covered, summary = self.context_manager.summary(self.all_messages)
+        state = {"model_key": self.last_local_model, "summary_covered": covered, "summary": summary}
+        with open(self.local_context_path(file_path), 'w', encoding='utf-8') as file:
+            json.dump(state, file, ensure_ascii=False, indent=4)
+
+    def restore_local_context(self, file_path):
+        """
+        加载对话后恢复滚动摘要，并在后台让本地模型预填充对话前缀，
+        下一轮提问时 Ollama 复用已缓存的 KV，只需评估新增的 token。
+        """
+        try:
+            with open(self.local_context_path(file_path), 'r', encoding='utf-8') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"读取本地模型上下文失败: {e}")
+            return
+        history = self.all_messages
+        if state.get("summary"):
+            self.context_manager.restore(history, state.get("summary_covered", 0), state["summary"])
+        model_key = state.get("model_key")
+        if model_key in self.models and "local" in model_key:
+            self.scheduler.executor.submit(self.prefill_local_context, model_key, history)
+
+    def prefill_local_context(self, model_key, history):
+        """
+        以与正式请求相同的 options 发送对话前缀，只生成 1 个 token，使 Ollama 缓存其 KV。
+        """
+        model = self.models[model_key]
+        messages = self.context_manager.build(history, model, self.max_tokens_for(model))
+        if len(messages) < 2:
+            return
+        try:
+            with self.scheduler.provider_slot(model_key):
+                response = self.ollama.post(
+                    f"{self.ollama_url}/api/chat",
+                    json={"model": model, "messages": messages, "stream": False,
+                          "options": {**self.ollama_options(model), "num_predict": 1},
+                          "keep_alive": self.model_manager.keep_alive_for(model)},
+                    timeout=self.ollama_timeout,
+                )
+                response.raise_for_status()
+            stats = self._ollama_eval_stats(model, response.json())
+            logger.info(f"{model} 已预填充对话上下文: {stats['prompt_eval_count']} tokens, "
+                        f"用时 {stats['prompt_eval_duration']:.2f}s")
+        except Exception as e:
+            logger.warning(f"{model} 预填充对话上下文失败: {e}")
 
     def output_area_sys_message(self, sys_message):
         cursor = self.output_area.textCursor()
@@ -604,11 +2124,14 @@ class MultiAI(QMainWindow):
                 with open(file_path, 'w', encoding='utf-8') as file:
                     json.dump(self.all_messages, file, ensure_ascii=False, indent=4)
                     self.output_area_sys_message("对话已成功保存！")
+                self.save_local_context(file_path)
             except Exception as e:
                 self.output_area_sys_message(f"保存对话失败: {e}")
 
     def clear_message(self):
+        self.context_manager.forget(self.all_messages)
         self.all_messages = [{"role": "system", "content": "You are a helpful assistant"}]
+        self.conversation_id += 1
         self.output_area_sys_message("对话已清除！")
         self.output_area_sys_message(f"{json.dumps(self.all_messages, indent=4, ensure_ascii=False)}\n")
 
@@ -617,37 +2140,1721 @@ class MultiAI(QMainWindow):
         formatted_messages = json.dumps(self.all_messages, indent=4, ensure_ascii=False)
         self.output_area_sys_message(formatted_messages)
 
+    def show_context_summary(self):
+        covered, summary = self.context_manager.summary(self.all_messages)
+        if not summary:
+            self.output_area_sys_message("当前对话尚无上下文摘要")
+            return
+        self.output_area_sys_message(f"上下文摘要（覆盖前 {covered} 条消息，约 {estimate_tokens(summary)} tokens）")
+        self.output_area_sys_message(summary)
+
     def show_web_context(self):
-        self.output_area_sys_message("以下是搜索结果")
-        self.output_area_sys_message(self.web_context)
+        self.output_area_sys_message(f"以下是搜索结果（共 {len(self.web_context)} 条）")
+        self.output_area_sys_message(self.web_context.format())
 
     def clear_web_context(self):
-        self.web_context = ""
+        self.web_context.clear()
+
+    def show_search_cache(self):
+        stats = self.search_cache.stats()
+        self.output_area_sys_message(
+            f"搜索缓存: 命中 {stats['hits']} 次, 未命中 {stats['misses']} 次, "
+            f"内存 {stats['memory_entries']} 条, 磁盘 {stats['disk_entries']} 条"
+        )
+        stats = self.page_fetcher.cache.stats()
+        self.output_area_sys_message(
+            f"网页缓存: 直接命中 {stats['fresh_hits']} 次, 验证未变 {stats['revalidated']} 次, "
+            f"下载 {stats['downloads']} 次; 节省 {format_bytes(stats['bytes_saved'])}, "
+            f"共 {stats['entries']} 页, 占用 {format_bytes(stats['stored_bytes'])}"
+        )
+
+    def clear_search_cache(self):
+        self.search_cache.clear()
+        self.page_fetcher.cache.clear()
+        self.output_area_sys_message("搜索缓存与网页缓存已清空！")
+
+    def toggle_deep_search(self, checked):
+        self.deep_search_enabled = checked
+        state = "开启" if checked else "关闭"
+        self.output_area_sys_message(
+            f"深度搜索已{state}（抓取前 {self.deep_search_top_k} 个结果，限时 {self.deep_search_timeout:.0f}s）")
+
+    def toggle_search_summary(self, checked):
+        self.search_summary_enabled = checked
+        state = "开启" if checked else "关闭"
+        self.output_area_sys_message(f"检索摘要已{state}（摘要模型 {self.search_summary_model() or '无'}）")
+
+    def toggle_response_cache(self, checked):
+        self.response_cache_enabled = checked
+        stats = self.response_cache.stats()
+        state = "开启" if checked else "关闭"
+        self.output_area_sys_message(f"回答缓存已{state}（已缓存 {stats['disk_entries']} 条）")
+
+    def clear_response_cache(self):
+        self.response_cache.clear()
+        self.semantic_cache.clear()
+        self.output_area_sys_message("回答缓存已清空！")
+
+    def toggle_semantic_cache(self, checked):
+        self.semantic_cache_enabled = checked
+        state = "开启" if checked else "关闭"
+        self.output_area_sys_message(
+            f"语义缓存已{state}（阈值 {self.semantic_cache.threshold}，已缓存 {len(self.semantic_cache)} 条）")
 
     def show_prompt(self):
         self.output_area_sys_message("显示提示词")
         self.output_area_sys_message(self.prompt_template)
 
-class Worker(QThread):
+def estimate_tokens(text):
+    """
+    粗略估算文本的 token 数（宁多勿少）：中日韩字符、标点与数字约每个 1 个 token，
+    字母约每 4 个 1 个 token，空白不计。代码、JSON 等标点密集的文本按 len/4 估算会少算一半左右。
+    """
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    symbols = len(re.findall(r'[^\w\s\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]|\d', text))
+    letters = len(re.findall(r'[^\W\d\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + symbols + (letters + 3) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    把文本截断到约 max_tokens 个 token，保留开头与结尾（提示词末尾通常是用户问题）。
+    """
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(int(len(text) * max_tokens / tokens * 0.95) - 20, 0)
+    head = keep // 3
+    return text[:head] + "\n...(内容过长已截断)...\n" + text[len(text) - (keep - head):]
+
+def strip_think(text):
+    """
+    去掉回复中的推理过程（<think>...</think>，包括中断时未闭合的部分）。
+    """
+    return re.sub(r'<think>.*?(</think>|$)', '', text, flags=re.IGNORECASE | re.DOTALL).strip()
+
+def _ignore_token(token):
+    """
+    不需要逐段显示时使用的空回调，使请求仍以流式发出以便随时取消。
+    """
+
+class CancelToken:
+    """
+    可跨线程取消的请求令牌，is_set/set 与 threading.Event 用法一致。
+    set() 时立即调用已登记的关闭函数断开流式连接，使阻塞在读取上的工作线程尽快退出。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._closers = []
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def set(self):
+        with self._lock:
+            self._event.set()
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception as e:
+                logger.debug(f"关闭连接失败: {e}")
+
+    def register(self, close):
+        """
+        登记取消时要调用的关闭函数；已取消时立即调用。
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._closers.append(close)
+                return
+        close()
+
+class RequestCancelled(Exception):
+    """
+    流式请求被取消时抛出，args[0] 为取消前已收到的部分回复。
+    """
+
+
+def raise_if_cancelled(cancel_event):
+    """
+    cancel_event 已被置位时抛出 RequestCancelled（尚无部分回复）。
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise RequestCancelled("")
+
+class Worker(QObject):
+    """
+    一次后台请求任务，由 RequestScheduler 在线程池中执行，进度与结果经信号回到 GUI 线程。
+    """
+    started_signal = pyqtSignal()  # 任务开始执行（排队结束）信号
     result_signal = pyqtSignal(str)
+    token_signal = pyqtSignal(str)  # 流式增量文本信号
+    stats_signal = pyqtSignal(dict)  # 生成统计信号
+    reply_signal = pyqtSignal(dict)  # 多模型模式下单个模型的回复信号
 
-    def __init__(self, func, *args, **kwargs):
+    def __init__(self, func, *args, stream=False, stats=False, replies=False, cancellable=False, **kwargs):
         super().__init__()
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        self.done = False
+        self.finished = threading.Event()
+        self.cancel_token = CancelToken()
+        if cancellable:
+            self.kwargs["cancel_event"] = self.cancel_token
+        if stream:
+            # 流式模式下把增量文本经信号转发到 GUI 线程
+            self.kwargs["on_token"] = self.token_signal.emit
+        if stats:
+            self.kwargs["on_stats"] = self.stats_signal.emit
+        if replies:
+            self.kwargs["on_reply"] = self.reply_signal.emit
+
+    def cancel(self):
+        self.cancel_token.set()
 
     def run(self):
-        result = self.func(*self.args, **self.kwargs)
+        self.started_signal.emit()
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            logger.error(f"后台任务失败: {e}")
+            result = f"请求异常: {e}"
+        self.done = True
+        self.finished.set()
         self.result_signal.emit(result)
 
+class RequestScheduler:
+    """
+    请求调度器：所有模型请求在一个可复用的线程池中执行。
+    同一对话内的任务按提交顺序依次执行，保证对话历史与回复顺序一致；
+    provider_slot 按模型提供方（本地 Ollama 共用一个配额）限制并发请求数。
+    被取消的任务若在 cancel_grace 秒内仍未退出（例如阻塞在模型加载或无响应的请求上），
+    不再占用对话队列，后续任务立即开始。
+    任务内部的并发子请求（多模型、竞速、检索摘要）使用单独的 inner_executor，
+    避免外层任务占满线程池后等待子请求而死锁。
+    """
+
+    def __init__(self, max_workers=8, local_limit=1, api_limit=4, cancel_grace=1.0, inner_workers=16):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Request")
+        self.inner_executor = ThreadPoolExecutor(max_workers=inner_workers, thread_name_prefix="Inner")
+        self.local_limit = local_limit
+        self.api_limit = api_limit
+        self.semaphores = {}
+        self.queues = {}  # conversation -> deque[(worker, submitted)]
+        self.active = set()  # 正在执行任务的对话
+        self.current = {}  # conversation -> 正在占用该对话队列的任务
+        self.released = set()  # 已取消并让出对话队列、但线程尚未退出的任务
+        self.cancel_grace = cancel_grace
+        self.running = 0
+        self.waiting_for_slot = 0
+        self.wait_times = deque(maxlen=50)
+        self.lock = threading.Lock()
+        self.on_change = None  # 队列状态变化回调，可能在任意线程中调用
+
+    def submit(self, worker, conversation=0):
+        with self.lock:
+            self.queues.setdefault(conversation, deque()).append((worker, time.perf_counter()))
+            if conversation not in self.active:
+                self._start_next(conversation)
+        self._notify()
+
+    def _start_next(self, conversation):
+        # 调用方需持有 self.lock
+        queue = self.queues.get(conversation)
+        if not queue:
+            self.active.discard(conversation)
+            self.queues.pop(conversation, None)
+            self.current.pop(conversation, None)
+            return
+        worker, submitted = queue.popleft()
+        self.active.add(conversation)
+        self.current[conversation] = worker
+        self.running += 1
+        self.wait_times.append(time.perf_counter() - submitted)
+        self.executor.submit(self._run, worker, conversation)
+
+    def _run(self, worker, conversation):
+        try:
+            worker.run()
+        finally:
+            with self.lock:
+                self.running -= 1
+                if worker in self.released:
+                    self.released.discard(worker)
+                else:
+                    self._start_next(conversation)
+            self._notify()
+
+    def cancel(self, worker):
+        """
+        取消 worker；其在 cancel_grace 秒内未退出时让出对话队列，使同一对话的后续任务不必等待它。
+        """
+        worker.cancel()
+
+        def release():
+            if worker.finished.wait(self.cancel_grace):
+                return
+            with self.lock:
+                for conversation, current in self.current.items():
+                    if current is worker:
+                        logger.info(f"已取消的任务仍未退出，让出对话 {conversation} 的队列")
+                        self.released.add(worker)
+                        self._start_next(conversation)
+                        break
+            self._notify()
+
+        threading.Thread(target=release, daemon=True).start()
+
+    @contextmanager
+    def provider_slot(self, model_key, timeout=None):
+        """
+        占用 model_key 所属提供方的一个并发配额，配额用尽时阻塞等待；
+        给出 timeout 时最多等待 timeout 秒，超时抛出 TimeoutError。
+        """
+        provider = "local" if "local" in model_key else model_key
+        with self.lock:
+            semaphore = self.semaphores.get(provider)
+            if semaphore is None:
+                limit = self.local_limit if provider == "local" else self.api_limit
+                semaphore = self.semaphores[provider] = threading.BoundedSemaphore(limit)
+            self.waiting_for_slot += 1
+        self._notify()
+        acquired = semaphore.acquire(timeout=timeout)
+        with self.lock:
+            self.waiting_for_slot -= 1
+        self._notify()
+        if not acquired:
+            raise TimeoutError(f"等待 {provider} 并发配额超时")
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": sum(len(queue) for queue in self.queues.values()),
+                "running": self.running,
+                "waiting_for_slot": self.waiting_for_slot,
+                "avg_wait": sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0,
+            }
+
+    def _notify(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def shutdown(self):
+        """
+        丢弃排队中的任务并取消正在执行的任务，使线程尽快退出。
+        """
+        with self.lock:
+            self.queues.clear()
+            running = list(self.current.values()) + list(self.released)
+        for worker in running:
+            worker.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.inner_executor.shutdown(wait=False, cancel_futures=True)
+
+def parse_overrides(text):
+    """
+    解析 "key=value,key=value" 形式的配置（如按模型的 keep_alive、按提供方的摘要模型）。
+    """
+    overrides = {}
+    for item in text.split(","):
+        key, sep, value = item.strip().rpartition("=")
+        if sep and key:
+            overrides[key.strip()] = value.strip()
+    return overrides
+
+def _windows_memory_status():
+    """
+    通过 GlobalMemoryStatusEx 读取 Windows 的内存状态，返回 (总字节数, 可用字节数)。
+    """
+    import ctypes
+
+    class MEMORYSTATUSEX(ctypes.Structure):
+        _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+    status = MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+    if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        raise OSError("GlobalMemoryStatusEx 调用失败")
+    return status.ullTotalPhys, status.ullAvailPhys
+
+def total_memory():
+    """
+    返回物理内存总字节数，无法获取时返回 None。
+    """
+    try:
+        if sys.platform == "win32":
+            return _windows_memory_status()[0]
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def available_memory():
+    """
+    返回当前可用内存字节数（Linux 的 MemAvailable、Windows 的 ullAvailPhys），
+    系统不提供可用内存时退回物理内存总量，都无法获取时返回 None。
+    """
+    try:
+        if sys.platform == "win32":
+            return _windows_memory_status()[1]
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (AttributeError, ValueError, OSError):
+        pass
+    return total_memory()
+
+def cpu_cores():
+    """
+    估算物理核心数：Linux 按 /proc/cpuinfo 中不同的 (physical id, core id) 计数，
+    其他系统按逻辑处理器数的一半（假定开启超线程）估算。
+    """
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            cores = set(re.findall(r"physical id\s*:\s*(\d+).*?core id\s*:\s*(\d+)", cpuinfo.read(), re.DOTALL))
+        if cores:
+            return len(cores)
+    except OSError:
+        pass
+    return max((os.cpu_count() or 2) // 2, 1)
+
+def format_bytes(size):
+    if size is None:
+        return "未知"
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+def parameter_billions(info):
+    """
+    从 /api/tags 的 parameter_size（如 "7.6B"、"500M"）解析参数量，单位为十亿。
+    """
+    match = re.match(r'([\d.]+)\s*([BM])', info.get("parameter_size", ""), re.IGNORECASE)
+    if not match:
+        return 0.0
+    value = float(match.group(1))
+    return value if match.group(2).upper() == "B" else value / 1000
+
+def fits_memory(info, ram, headroom=0.8):
+    """
+    模型文件大小（约等于加载所需内存）不超过可用内存 ram 的 headroom 比例时视为可运行；
+    内存未知时一律视为放不下。
+    """
+    if info is None or not ram:
+        return False
+    return info["size"] <= ram * headroom
+
+def pick_default_model(installed, ram, cpu_count):
+    """
+    选择可用内存放得下、参数量与物理核心数相称（每核约 4B 参数）的最大模型；
+    都不满足（包括内存未知）时选最小的模型。
+    """
+    if not installed:
+        return None
+    max_params = (cpu_count or 4) * 4
+    candidates = [info for info in installed
+                  if fits_memory(info, ram) and parameter_billions(info) <= max_params]
+    if candidates:
+        return max(candidates, key=lambda info: (parameter_billions(info), info["size"]))
+    return min(installed, key=lambda info: info["size"])
+
+class ModelRouter:
+    """
+    "auto" 模式的模型路由。
+    按每个模型实际调用（以及后台探测）得到的首字延迟、生成速度与错误率的指数加权移动平均（EWMA），
+    估算回答一个问题所需的时间，选择最快且错误率可接受的模型。
+    """
+
+    def __init__(self, alpha=0.3, max_error_rate=0.5, expected_tokens=400, default_ttft=3.0, default_tps=20.0):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.expected_tokens = expected_tokens
+        self.default_ttft = default_ttft
+        self.default_tps = default_tps
+        self.stats = {}  # model_key -> {"ttft", "tps", "prompt_tokens", "rtt", "error", "updated"}
+        self.lock = threading.Lock()
+
+    def _ewma(self, old, value):
+        return value if old is None else self.alpha * value + (1 - self.alpha) * old
+
+    def _entry(self, model_key):
+        return self.stats.setdefault(model_key, {
+            "ttft": None, "tps": None, "prompt_tokens": None, "rtt": None, "error": 0.0, "updated": 0.0,
+        })
+
+    def record(self, model_key, ttft, tokens_per_second, prompt_tokens):
+        with self.lock:
+            entry = self._entry(model_key)
+            entry["ttft"] = self._ewma(entry["ttft"], ttft)
+            if tokens_per_second > 0:
+                entry["tps"] = self._ewma(entry["tps"], tokens_per_second)
+            entry["prompt_tokens"] = self._ewma(entry["prompt_tokens"], max(prompt_tokens, 1))
+            entry["error"] = self._ewma(entry["error"], 0.0)
+            entry["updated"] = time.monotonic()
+
+    def record_error(self, model_key):
+        with self.lock:
+            entry = self._entry(model_key)
+            entry["error"] = self._ewma(entry["error"], 1.0)
+            entry["updated"] = time.monotonic()
+
+    def record_probe(self, model_key, rtt):
+        """
+        记录一次探测的往返时间，rtt 为 None 表示探测失败。
+        """
+        with self.lock:
+            entry = self._entry(model_key)
+            if rtt is None:
+                entry["error"] = self._ewma(entry["error"], 1.0)
+            else:
+                entry["rtt"] = self._ewma(entry["rtt"], rtt)
+                entry["error"] = self._ewma(entry["error"], 0.0)
+            entry["updated"] = time.monotonic()
+
+    def stale(self, model_key, max_age):
+        with self.lock:
+            entry = self.stats.get(model_key)
+            return entry is None or time.monotonic() - entry["updated"] >= max_age
+
+    def estimate(self, model_key, prompt_tokens, penalty=0.0):
+        """
+        预计回答时间 = 额外开销 + 首字延迟（按提示词长度缩放）+ 预计生成 token 数 / 生成速度，再按错误率放大。
+        尚无实测首字延迟时以探测往返时间的两倍或默认值代替。
+        """
+        with self.lock:
+            entry = dict(self.stats.get(model_key) or
+                         {"ttft": None, "tps": None, "prompt_tokens": None, "rtt": None, "error": 0.0})
+        if entry["ttft"] is not None:
+            ttft = entry["ttft"] * max(1.0, prompt_tokens / entry["prompt_tokens"])
+        elif entry["rtt"] is not None:
+            ttft = entry["rtt"] * 2
+        else:
+            ttft = self.default_ttft
+        seconds = penalty + ttft + self.expected_tokens / (entry["tps"] or self.default_tps)
+        return seconds / max(1.0 - entry["error"], 0.05)
+
+    def choose(self, candidates, prompt_tokens):
+        """
+        candidates 为 {model_key: 额外开销秒数}，返回 (最快的 model_key, 预计秒数)。
+        错误率超过 max_error_rate 的模型只在没有其他选择时使用。
+        """
+        with self.lock:
+            healthy = [key for key in candidates
+                       if self.stats.get(key, {}).get("error", 0.0) <= self.max_error_rate]
+        estimates = {key: self.estimate(key, prompt_tokens, candidates[key]) for key in healthy or candidates}
+        model_key = min(estimates, key=estimates.get)
+        return model_key, estimates[model_key]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                key: {name: round(value, 3) if isinstance(value, float) else value
+                      for name, value in entry.items() if name != "updated"}
+                for key, entry in self.stats.items()
+            }
+
+class SearchClassifier:
+    """
+    判断一个问题是否需要联网检索：先用规则识别明显需要（时效性问题）与明显不需要（寒暄、
+    针对上文或给定文本的任务）的情况，其余不确定的问题交给可选的小模型（ask 返回 True/False/None），
+    没有小模型或小模型无法判断时默认检索。同时按 EWMA 估计一次检索的耗时，统计跳过检索节省的时间。
+    """
+
+    TIMELY = re.compile(
+        r"最新|最近|近期|今天|今日|昨天|明天|今年|去年|本周|这周|本月|现在|目前|当前|如今|实时|新闻|消息|动态|"
+        r"价格|股价|汇率|油价|天气|比分|赛程|排名|发布|上市|版本|官网|政策|谁是|多少钱|20[2-9]\d|"
+        r"\b(latest|recent|news|today|tonight|yesterday|tomorrow|current|now|price|weather|score|release)\b|https?://",
+        re.IGNORECASE)
+    CHITCHAT = re.compile(
+        r"^(你好|您好|嗨|哈喽|在吗|在不在|谢谢|多谢|感谢|好的|好|嗯|行|收到|明白了?|再见|拜拜|早上好|早安|晚上好|晚安|"
+        r"辛苦了|不客气|没事|hi|hello|hey|thanks|thank you|ok|okay|bye|good (morning|night))[\s!！。.,，~～?？]*$",
+        re.IGNORECASE)
+    # “上面/刚才/前面”等只有在指代上文（上面的代码、你刚才说的……）时才算，避免误伤“月球上面有水吗”这类问题
+    OFFLINE_TASK = re.compile(
+        r"^(请)?(帮我)?(翻译|润色|改写|重写|续写|扩写|缩写|校对|纠错|总结|概括|解释一下这|写一[首篇段个封]|写个|"
+        r"把(这|上面|下面))|"
+        r"(上面|上文|前面|刚才|你刚)(你|我)?(所)?(说|提到|讲|写|给出|回答|列出)|"
+        r"(上面|上文|前面|刚才)(的|这|那)(一)?[段个些句条]?(代码|内容|回答|答案|文字|文本|话|例子|问题|方案|步骤|结果)|"
+        r"^(上面|上文)|以下(代码|文本|内容)|这段(代码|话|文字)|```|"
+        r"^(translate|rewrite|summari[sz]e|proofread|write a|fix this)\b",
+        re.IGNORECASE)
+
+    def __init__(self, ask=None, alpha=0.3, default_search_seconds=2.0):
+        self.ask = ask
+        self.alpha = alpha
+        self.search_seconds = default_search_seconds
+        self.searched = 0
+        self.skipped = 0
+        self.saved_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def decide(self, question):
+        """
+        返回 (是否检索, 理由)。
+        """
+        text = question.strip()
+        if self.TIMELY.search(text):
+            return True, "时效性问题"
+        if self.CHITCHAT.match(text):
+            return False, "寒暄"
+        if self.OFFLINE_TASK.search(text):
+            return False, "针对上文或给定文本的任务"
+        # 只有没有任何文字（纯标点、表情等）的输入才直接跳过；短的关键词、人名、产品名正是典型的搜索词
+        if not re.search(r"\w", text):
+            return False, "没有文字内容"
+        if self.ask is not None:
+            verdict = self.ask(text)
+            if verdict is not None:
+                return verdict, "小模型判断" + ("需要" if verdict else "不需要")
+        return True, "不确定，默认检索"
+
+    def record_search(self, seconds):
+        with self.lock:
+            self.searched += 1
+            self.search_seconds = self.alpha * seconds + (1 - self.alpha) * self.search_seconds
+
+    def record_skip(self):
+        """
+        记录一次跳过的检索，返回按近期检索耗时估计的节省时间（秒）。
+        """
+        with self.lock:
+            self.skipped += 1
+            self.saved_seconds += self.search_seconds
+            return self.search_seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {"searched": self.searched, "skipped": self.skipped,
+                    "saved_seconds": self.saved_seconds, "search_seconds": self.search_seconds}
+
+
+class LocalModelManager:
+    """
+    本地 Ollama 模型的生命周期管理。
+    选中时在后台预加载模型；每个请求附带按模型配置的 keep_alive，大模型空闲较短时间后即由 Ollama 卸载以释放内存；
+    定期通过 /api/ps 同步各模型的实际加载状态。状态变化时调用 on_change（可能在后台线程中）。
+    """
+    UNLOADED = "未加载"
+    LOADING = "加载中"
+    LOADED = "已加载"
+    FAILED = "加载失败"
+
+    def __init__(self, session, base_url, timeout, keep_alive="30m", overrides=None):
+        self.session = session
+        self.base_url = base_url
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.overrides = overrides or {}
+        self.states = {}
+        self.on_change = None
+        self.lock = threading.Lock()
+
+    def keep_alive_for(self, model):
+        return self.overrides.get(model, self.keep_alive)
+
+    def state(self, model):
+        with self.lock:
+            return self.states.get(model, self.UNLOADED)
+
+    def _set_state(self, model, state):
+        with self.lock:
+            changed = self.states.get(model, self.UNLOADED) != state
+            self.states[model] = state
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def preload(self, model, options):
+        """
+        发送不含消息的 /api/chat 请求让 Ollama 载入模型；options 须与正式请求一致，否则会再次载入。
+        """
+        if self.state(model) in (self.LOADING, self.LOADED):
+            return
+        self._set_state(model, self.LOADING)
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/chat",
+                json={"model": model, "messages": [], "options": options,
+                      "keep_alive": self.keep_alive_for(model)},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"预加载模型 {model} 失败: {e}")
+            self._set_state(model, self.FAILED)
+            return
+        load_duration = response.json().get("load_duration", 0) / 1e9
+        logger.info(f"模型 {model} 已加载，用时 {load_duration:.1f}s，keep_alive={self.keep_alive_for(model)}")
+        self._set_state(model, self.LOADED)
+
+    def mark_loaded(self, model):
+        self._set_state(model, self.LOADED)
+
+    def installed(self):
+        """
+        通过 /api/tags 查询已安装的对话模型（排除嵌入模型），失败时返回 None。
+        """
+        try:
+            response = self.session.get(f"{self.base_url}/api/tags", timeout=self.timeout)
+            response.raise_for_status()
+            entries = response.json().get("models", [])
+        except Exception as e:
+            logger.warning(f"查询本地模型列表失败: {e}")
+            return None
+        models = []
+        for entry in entries:
+            details = entry.get("details") or {}
+            families = details.get("families") or [details.get("family", "")]
+            if "embed" in entry["name"] or any(family in ("bert", "nomic-bert") for family in families):
+                continue
+            models.append({
+                "name": entry["name"],
+                "size": entry.get("size", 0),
+                "parameter_size": details.get("parameter_size", ""),
+                "quantization": details.get("quantization_level", ""),
+            })
+        return models
+
+    def refresh(self, models):
+        """
+        按 /api/ps 返回的已加载模型更新 models 的状态（加载中的模型除外）。
+        """
+        try:
+            response = self.session.get(f"{self.base_url}/api/ps", timeout=self.timeout)
+            response.raise_for_status()
+            running = response.json().get("models", [])
+        except Exception as e:
+            logger.debug(f"查询已加载模型失败: {e}")
+            return
+        loaded = {entry.get("name") for entry in running} | {entry.get("model") for entry in running}
+        for model in models:
+            if self.state(model) == self.LOADING:
+                continue
+            if model in loaded:
+                self._set_state(model, self.LOADED)
+            elif self.state(model) == self.LOADED:
+                self._set_state(model, self.UNLOADED)
+
+class TokenCounter:
+    """
+    估算消息的 token 数并缓存：每条消息只计算一次，对话总数按新增消息增量累计。
+    """
+
+    def __init__(self, message_overhead=4, max_cached=4096):
+        self.message_overhead = message_overhead
+        self.max_cached = max_cached
+        self.cache = OrderedDict()  # id(message) -> (message, tokens)
+        self.totals = {}  # id(history) -> (history, 已计数的消息数, 总 token 数)
+        self.lock = threading.Lock()
+
+    def message_tokens(self, message):
+        key = id(message)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] is message:
+                self.cache.move_to_end(key)
+                return entry[1]
+        tokens = estimate_tokens(message["content"]) + self.message_overhead
+        with self.lock:
+            self.cache[key] = (message, tokens)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+        return tokens
+
+    def history_tokens(self, history):
+        with self.lock:
+            entry = self.totals.get(id(history))
+        if entry is None or entry[0] is not history or entry[1] > len(history):
+            counted, total = 0, 0
+        else:
+            _, counted, total = entry
+        for message in history[counted:]:
+            total += self.message_tokens(message)
+        with self.lock:
+            self.totals[id(history)] = (history, len(history), total)
+        return total
+
+    def forget(self, history):
+        with self.lock:
+            self.totals.pop(id(history), None)
+
+class ModelMetrics:
+    """
+    按模型累计请求数、提示词/生成 token 数、首字延迟（TTFT）与生成速度，供“查看模型指标”显示。
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def record(self, model, prompt_tokens, completion_tokens, ttft, generation_time, estimated=False):
+        with self.lock:
+            metrics = self.models.setdefault(model, {
+                "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "ttft_total": 0.0, "ttft_count": 0, "generation_time": 0.0, "estimated": 0,
+            })
+            metrics["requests"] += 1
+            metrics["prompt_tokens"] += prompt_tokens
+            metrics["completion_tokens"] += completion_tokens
+            metrics["generation_time"] += generation_time
+            if ttft is not None:
+                metrics["ttft_total"] += ttft
+                metrics["ttft_count"] += 1
+            if estimated:
+                metrics["estimated"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return [
+                {
+                    "model": model,
+                    "requests": metrics["requests"],
+                    "prompt_tokens": metrics["prompt_tokens"],
+                    "completion_tokens": metrics["completion_tokens"],
+                    "ttft": metrics["ttft_total"] / metrics["ttft_count"] if metrics["ttft_count"] else None,
+                    "tokens_per_second": (metrics["completion_tokens"] / metrics["generation_time"]
+                                          if metrics["generation_time"] > 0 else 0.0),
+                    "estimated": metrics["estimated"],
+                }
+                for model, metrics in self.models.items()
+            ]
+
+class ContextManager:
+    """
+    按模型上下文窗口的 token 预算构造发送给模型的消息列表。
+    最近的 keep_recent 条消息原样保留，更早的消息在后台被折叠为滚动摘要；
+    摘要尚未生成时，超出预算的最早消息被直接舍弃，保证请求不超过窗口。
+    token 数为估算值，除固定的 reserve 外还按窗口的 margin 比例留出余量。
+    """
+
+    def __init__(self, counter, windows, default_window=4096, keep_recent=6, reserve=256, margin=0.1):
+        self.counter = counter
+        self.windows = windows
+        self.default_window = default_window
+        self.keep_recent = keep_recent
+        self.reserve = reserve
+        self.margin = margin  # token 数只是估算，按窗口比例额外留出余量
+        self.summaries = {}  # id(history) -> {"history": history, "covered": n, "text": 摘要}
+        self.folding = set()  # 正在生成摘要的 id(history)
+        self.forgotten = set()  # 已被清除/替换的对话，迟到的摘要不再写入
+        self.lock = threading.Lock()
+
+    def window(self, model):
+        return self.windows.get(model, self.default_window)
+
+    def output_limit(self, model, max_tokens):
+        """
+        把生成上限限制在 model 窗口的一半以内，避免提示词预算为负、本轮问题被截断。
+        """
+        return max(1, min(max_tokens, self.window(model) // 2))
+
+    def message_tokens(self, message):
+        return self.counter.message_tokens(message)
+
+    def summary(self, history):
+        """
+        返回 (已折叠的消息数, 摘要文本)。
+        """
+        with self.lock:
+            state = self.summaries.get(id(history))
+            if state is None or state["history"] is not history:
+                return 0, ""
+            return state["covered"], state["text"]
+
+    def build(self, history, model, max_tokens, request=None):
+        """
+        返回在 model 窗口内的消息列表：系统提示 + 摘要 + 能放下的最近消息 + request。
+        request 替换 history 的最后一条消息（本轮的原始问题）；为 None 时按原样发送 history。
+        """
+        window = self.window(model)
+        budget = window - self.output_limit(model, max_tokens) - max(self.reserve, int(window * self.margin))
+        system = [history[0]] if history and history[0]["role"] == "system" else []
+        covered, summary = self.summary(history)
+        if request is None:
+            turns = history[len(system) + covered:]
+        else:
+            turns = history[len(system) + covered:-1] + [request]
+
+        prefix = list(system)
+        if summary:
+            prefix.append({"role": "system", "content": f"以下是之前对话的摘要：\n{summary}"})
+        used = sum(self.message_tokens(message) for message in prefix)
+
+        # 从最新的消息往前装入，最后一条消息（当前问题）必须保留
+        kept = []
+        for message in reversed(turns):
+            tokens = self.message_tokens(message)
+            if kept and used + tokens > budget:
+                break
+            if not kept and used + tokens > budget:
+                message = {**message, "content": truncate_to_tokens(
+                    message["content"], max(budget - used - self.counter.message_overhead, 1))}
+                tokens = self.message_tokens(message)
+            kept.append(message)
+            used += tokens
+        dropped = len(turns) - len(kept)
+        if dropped:
+            logger.info(f"{model} 上下文超出预算，舍弃 {dropped} 条较早的消息")
+        return prefix + kept[::-1]
+
+    def claim_fold(self, history):
+        """
+        若有超出 keep_recent 的未折叠消息，返回折叠后应覆盖的消息数并标记为处理中，否则返回 None。
+        """
+        system = 1 if history and history[0]["role"] == "system" else 0
+        covered, _ = self.summary(history)
+        fold = len(history) - system - self.keep_recent
+        if fold - covered < self.keep_recent:
+            return None
+        with self.lock:
+            if id(history) in self.folding:
+                return None
+            self.folding.add(id(history))
+        return fold
+
+    def release_fold(self, history):
+        with self.lock:
+            self.folding.discard(id(history))
+
+    def summary_prompt(self, history, fold):
+        system = 1 if history and history[0]["role"] == "system" else 0
+        covered, summary = self.summary(history)
+        lines = []
+        for message in history[system + covered:system + fold]:
+            lines.append(f"{message['role']}: {truncate_to_tokens(strip_think(message['content']), 400)}")
+        dialog = "\n".join(lines)
+        return (
+            "请把已有摘要与新增对话合并为一份不超过300字的中文摘要，"
+            "保留关键事实、结论、用户偏好和尚未解决的问题，只输出摘要本身。\n\n"
+            f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{dialog}"
+        )
+
+    def apply_fold(self, history, fold, summary):
+        with self.lock:
+            self.folding.discard(id(history))
+            if id(history) in self.forgotten:
+                self.forgotten.discard(id(history))
+            elif summary:
+                self.summaries[id(history)] = {"history": history, "covered": fold, "text": summary}
+
+    def restore(self, history, covered, summary):
+        """
+        恢复随对话文件保存的摘要。
+        """
+        with self.lock:
+            self.summaries[id(history)] = {"history": history, "covered": covered, "text": summary}
+
+    def forget(self, history):
+        """
+        对话被清除或替换时丢弃其摘要。
+        """
+        self.counter.forget(history)
+        with self.lock:
+            self.summaries.pop(id(history), None)
+            if id(history) in self.folding:
+                self.forgotten.add(id(history))
+
+class WebContextStore:
+    """
+    网络检索结果存储：按 URL 去重，超过 max_records 时淘汰最久未出现的结果。
+    构造提示词时以句子为单位做抽取式压缩：按与当前问题的 BM25 相关度和检索时效打分，在 token 预算内挑选句子。
+    """
+
+    def __init__(self, max_records=100, recency_weight=0.3, recency_decay=0.5):
+        self.max_records = max_records
+        self.recency_weight = recency_weight
+        self.recency_decay = recency_decay
+        self.records = OrderedDict()  # URL -> {"title", "link", "snippet", "turn"}
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize_url(url):
+        return url.split("#", 1)[0].rstrip("/").lower()
+
+    # 常见的页面模板文字：只有较短（去掉标点后不超过 BOILERPLATE_MAX_LENGTH 个字符）
+    # 且与问题没有共同词项的句子才视为模板，避免误删讨论 cookie、注册流程等内容的句子
+    BOILERPLATE_MAX_LENGTH = 40
+    BOILERPLATE = re.compile(
+        r'cookie|all rights reserved|copyright|privacy policy|sign in|log in|subscribe|read more|click here'
+        r'|版权所有|隐私政策|登录|注册|扫码|关注我们|阅读全文|点击查看|免责声明|上一篇|下一篇',
+        re.IGNORECASE)
+
+    @staticmethod
+    def term_list(text):
+        """
+        提取用于相关度计算的词项（保留重复）：拉丁字母/数字按单词，中日韩文字按相邻二字。
+        """
+        text = text.casefold()
+        words = re.findall(r'[a-z0-9]+', text)
+        for run in re.findall(r'[\u3040-\u9fff\uac00-\ud7af]+', text):
+            words.extend(run[i:i + 2] for i in range(max(len(run) - 1, 1)))
+        return words
+
+    @classmethod
+    def terms(cls, text):
+        return set(cls.term_list(text))
+
+    def add(self, query, results):
+        """
+        记入一次搜索的结果，返回新增的结果数；已收录的 URL 只刷新摘要与时效。
+        """
+        added = 0
+        with self.lock:
+            self.turn += 1
+            for result in results:
+                link = result.get("link")
+                if not link:
+                    continue
+                key = self.normalize_url(link)
+                if key not in self.records:
+                    added += 1
+                previous = self.records.get(key, {})
+                self.records[key] = {
+                    "title": result.get("title", "N/A"),
+                    "link": link,
+                    "snippet": result.get("snippet", "N/A"),
+                    "content": result.get("content") or previous.get("content", ""),
+                    "turn": self.turn,
+                }
+                self.records.move_to_end(key)
+            while len(self.records) > self.max_records:
+                self.records.popitem(last=False)
+        return added
+
+    @staticmethod
+    def format_record(record):
+        text = f"Title: {record['title']}\nLink: {record['link']}\nSnippet: {record['snippet']}"
+        if record.get("content"):
+            text += f"\nContent: {record['content']}"
+        return text
+
+    def sentences(self, records, question_terms=frozenset()):
+        """
+        把各条结果的摘要与正文切分为句子，去掉过短、重复和模板文字，返回 [(记录序号, 句子)]。
+        与 question_terms 有共同词项的句子不会被当作模板文字去掉。
+        """
+        sentences = []
+        seen = set()
+        for index, record in enumerate(records):
+            text = f"{record['snippet']}\n{record.get('content', '')}"
+            for sentence in re.split(r'(?<=[。！？!?；;])|(?<=\.)\s+|\n+', text):
+                sentence = sentence.strip()
+                key = re.sub(r'\W+', '', sentence.casefold())
+                if len(key) < 8 or key in seen:
+                    continue
+                if (len(key) <= self.BOILERPLATE_MAX_LENGTH and self.BOILERPLATE.search(sentence)
+                        and not (self.terms(sentence) & question_terms)):
+                    continue
+                seen.add(key)
+                sentences.append((index, sentence))
+        return sentences
+
+    def pack(self, question, max_tokens):
+        """
+        抽取式压缩：按 BM25 相关度（结合检索时效）给检索结果中的每个句子打分，
+        在 max_tokens 内贪心选取得分最高且互不重复的句子，按来源分组输出，句子保持原文顺序。
+        有句子与问题相关时，完全不相关的句子不会入选。
+        """
+        with self.lock:
+            records = list(self.records.values())
+            turn = self.turn
+        sentences = self.sentences(records, self.terms(question))
+        if not sentences:
+            return ""
+        relevance = bm25_scores(self.term_list(question), [self.term_list(sentence) for _, sentence in sentences])
+        has_relevant = relevance.max() > 0
+        if has_relevant:
+            relevance = relevance / relevance.max()
+        recency = np.array([self.recency_decay ** (turn - records[index]["turn"]) for index, _ in sentences])
+        scores = (1 - self.recency_weight) * relevance + self.recency_weight * recency
+
+        selected = {}  # 记录序号 -> [(句子序号, 句子)]，按首次入选顺序排列
+        chosen_terms = []
+        used = 0
+        for position in np.argsort(-scores, kind="stable"):
+            # 排序混合了时效，不相关的新句子可能排在相关的旧句子之前，因此跳过而不是停止
+            if has_relevant and relevance[position] <= 0:
+                continue
+            index, sentence = sentences[position]
+            record = records[index]
+            cost = estimate_tokens(sentence) + 1
+            if index not in selected:
+                cost += estimate_tokens(f"[{len(selected) + 1}] {record['title']} ({record['link']})") + 2
+            if used + cost > max_tokens:
+                continue
+            terms = self.terms(sentence)
+            if any(len(terms & other) > 0.8 * len(terms | other) for other in chosen_terms):
+                continue
+            chosen_terms.append(terms)
+            selected.setdefault(index, []).append((position, sentence))
+            used += cost
+
+        blocks = []
+        for number, (index, picked) in enumerate(selected.items(), 1):
+            record = records[index]
+            text = " ".join(sentence for _, sentence in sorted(picked))
+            blocks.append(f"[{number}] {record['title']} ({record['link']})\n{text}")
+        return "\n\n".join(blocks)
+
+    def format(self):
+        with self.lock:
+            return "\n\n".join(self.format_record(record) for record in self.records.values())
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def __len__(self):
+        return len(self.records)
+
+class PersistentCache:
+    """
+    带内存 LRU 层与 SQLite 持久化层的键值缓存，值以 JSON 形式保存。
+    ttl 为过期秒数（None 表示不过期），max_entries 限制磁盘条目数，超出时按最近访问时间淘汰。
+    """
+
+    def __init__(self, db_path, table="cache", ttl=None, memory_size=128, max_entries=None):
+        self.table = table
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.memory = OrderedDict()  # key -> (value, created)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+            )
+            if ttl is not None:
+                self.conn.execute(f"DELETE FROM {table} WHERE created < ?", (time.time() - ttl,))
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        查找缓存，未命中或已过期时返回 None。
+        """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                row = self.conn.execute(
+                    f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+            if entry is None or self._expired(entry[1]):
+                if entry is not None:
+                    self._delete(key)
+                self.misses += 1
+                return None
+            self._remember(key, *entry)
+            with self.conn:
+                self.conn.execute(
+                    f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (time.time(), key)
+                )
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self._remember(key, value, now)
+            with self.conn:
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), now, now)
+                )
+                if self.max_entries is not None:
+                    self.conn.execute(
+                        f"DELETE FROM {self.table} WHERE key NOT IN "
+                        f"(SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT ?)",
+                        (self.max_entries,)
+                    )
+
+    def _delete(self, key):
+        self.memory.pop(key, None)
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def stats(self):
+        with self.lock:
+            disk_entries = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": disk_entries,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            with self.conn:
+                self.conn.execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class SemanticCache:
+    """
+    基于本地 Ollama 嵌入向量的语义回答缓存。
+    每个模型作用域保存一个归一化的 float32 向量矩阵，查询时以矩阵乘法计算余弦相似度，
+    超过阈值即返回缓存回答。索引以 .npz 文件保存。
+    """
+
+    def __init__(self, path, embed_model="nomic-embed-text", threshold=0.92, max_entries=1000,
+                 base_url="http://localhost:11434", session=None):
+        self.path = path
+        self.session = session or requests.Session()
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.base_url = base_url
+        self.vectors = {}  # scope -> np.ndarray(n, dim)
+        self.entries = {}  # scope -> [{"question": ..., "answer": ...}]
+        self.lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def embed(self, text):
+        """
+        调用本地 Ollama /api/embed 获取归一化向量，失败时返回 None。
+        """
+        try:
+            response = self.session.post(
+                f"{self.base_url}/api/embed",
+                json={"model": self.embed_model, "input": text},
+                timeout=10
+            )
+            response.raise_for_status()
+            vector = np.asarray(response.json()["embeddings"][0], dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"获取嵌入向量失败: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def lookup(self, scope, question):
+        """
+        返回 (回答, 相似度, 问题向量)；未命中时回答为 None，向量可复用于 add。
+        """
+        vector = self.embed(question)
+        if vector is None:
+            return None, 0.0, None
+        with self.lock:
+            matrix = self.vectors.get(scope)
+            if matrix is None or matrix.shape[1] != vector.shape[0]:
+                return None, 0.0, vector
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                return None, similarity, vector
+            return self.entries[scope][best]["answer"], similarity, vector
+
+    def add(self, scope, question, answer, vector):
+        with self.lock:
+            matrix = self.vectors.get(scope)
+            if matrix is None or matrix.shape[1] != vector.shape[0]:
+                matrix = np.empty((0, vector.shape[0]), dtype=np.float32)
+                self.entries[scope] = []
+            self.vectors[scope] = np.vstack([matrix, vector[np.newaxis, :]])[-self.max_entries:]
+            self.entries[scope].append({"question": question, "answer": answer})
+            self.entries[scope] = self.entries[scope][-self.max_entries:]
+
+    def clear(self):
+        with self.lock:
+            self.vectors.clear()
+            self.entries.clear()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                meta = json.loads(str(data["meta"]))
+                for index, scope in enumerate(meta["scopes"]):
+                    self.vectors[scope] = data[f"vectors_{index}"]
+                    self.entries[scope] = meta["entries"][index]
+        except Exception as e:
+            logger.warning(f"加载语义缓存失败: {e}")
+
+    def save(self):
+        with self.lock:
+            if not self.entries and not os.path.exists(self.path):
+                return
+            scopes = list(self.vectors)
+            arrays = {f"vectors_{index}": self.vectors[scope] for index, scope in enumerate(scopes)}
+            meta = {"scopes": scopes, "entries": [self.entries[scope] for scope in scopes]}
+            try:
+                with open(self.path, "wb") as file:
+                    np.savez_compressed(file, meta=np.array(json.dumps(meta, ensure_ascii=False)), **arrays)
+            except Exception as e:
+                logger.warning(f"保存语义缓存失败: {e}")
+
+class AsyncLoopThread:
+    """
+    应用级的后台 asyncio 事件循环线程，所有异步网络 I/O（搜索、网页抓取、语音合成等）共用这一个循环。
+    submit 可在任意线程调用，返回 concurrent.futures.Future。
+    Ollama 与 OpenAI 兼容接口的模型请求使用同步客户端，仍在 RequestScheduler 的线程池中执行，
+    由 provider_slot 限流、由 CancelToken 断开连接来取消。
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="AsyncLoop", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        提交协程并阻塞等待结果，只能在工作线程中调用，不能在 GUI 线程中调用。
+        """
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=2)
+
+class PageTextParser(HTMLParser):
+    """
+    流式网页正文提取器：可分段 feed，跳过脚本、样式、导航等区块，按块级元素切分段落。
+    """
+    SKIP_TAGS = {"script", "style", "noscript", "nav", "header", "footer", "aside", "form",
+                 "svg", "iframe", "template", "button", "select"}
+    BLOCK_TAGS = {"p", "div", "li", "h1", "h2", "h3", "h4", "h5", "h6", "article", "section", "main",
+                  "br", "tr", "td", "pre", "blockquote", "dd", "dt", "table", "ul", "ol"}
+
+    def __init__(self, min_length=20):
+        super().__init__(convert_charrefs=True)
+        self.min_length = min_length
+        self.skip_depth = 0
+        self.current = []
+        self.paragraphs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.current.append(data)
+
+    def _flush(self):
+        text = " ".join("".join(self.current).split())
+        self.current = []
+        # 过短的文本多为菜单、按钮等页面部件
+        if len(text) >= self.min_length:
+            self.paragraphs.append(text)
+
+    def text(self):
+        self._flush()
+        return self.paragraphs
+
+def chunk_paragraphs(paragraphs, max_tokens=150):
+    """
+    把段落合并为不超过 max_tokens 的片段，过长的段落按长度切开。
+    """
+    chunks = []
+    current = []
+    used = 0
+    for paragraph in paragraphs:
+        tokens = estimate_tokens(paragraph)
+        while tokens > max_tokens:
+            cut = max(int(len(paragraph) * max_tokens / tokens), 1)
+            pieces = [paragraph[:cut]]
+            paragraph = paragraph[cut:]
+            tokens = estimate_tokens(paragraph)
+            chunks.extend(pieces)
+        if current and used + tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, used = [], 0
+        if paragraph:
+            current.append(paragraph)
+            used += tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def bm25_scores(query_terms, documents, k1=1.5, b=0.75):
+    """
+    用 NumPy 批量计算每个文档（词项列表）对查询词项的 BM25 得分。
+    """
+    vocabulary = {term: column for column, term in enumerate(dict.fromkeys(query_terms))}
+    if not documents or not vocabulary:
+        return np.zeros(len(documents), dtype=np.float32)
+    tf = np.zeros((len(documents), len(vocabulary)), dtype=np.float32)
+    for row, document in enumerate(documents):
+        for term in document:
+            column = vocabulary.get(term)
+            if column is not None:
+                tf[row, column] += 1
+    lengths = np.array([len(document) for document in documents], dtype=np.float32)
+    df = (tf > 0).sum(axis=0)
+    idf = np.log((len(documents) - df + 0.5) / (df + 0.5) + 1.0)
+    norm = k1 * (1 - b + b * lengths / (lengths.mean() or 1.0))
+    return (idf * tf * (k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+def rank_chunks(question, chunks):
+    """
+    按 BM25 相关度对片段排序（同分时保持页面中的先后顺序）。
+    """
+    scores = bm25_scores(WebContextStore.term_list(question), [WebContextStore.term_list(chunk) for chunk in chunks])
+    return [chunks[index] for index in np.argsort(-scores, kind="stable")]
+
+class PageFetcher:
+    """
+    并发抓取网页正文。
+    在应用共用的事件循环中维护独立的 aiohttp 会话：连接池总量为 pool_size，每个主机最多 per_host 个连接；
+    响应体边下载边交给 PageTextParser 解析，超过 max_bytes 即停止读取。
+    传入 cache（PageCache）时，新鲜的页面直接从缓存读取，过期页面以条件请求重新验证。
+    """
+    USER_AGENT = "Mozilla/5.0 (compatible; MultiAI/1.0)"
+
+    def __init__(self, async_loop, proxy_url=None, pool_size=10, per_host=2, max_bytes=1_500_000,
+                 connect_timeout=5, cache=None):
+        self.async_loop = async_loop
+        self.cache = cache
+        self.proxy_url = proxy_url or None
+        self.pool_size = pool_size
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout)
+        self.session = None
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.per_host,
+                                             ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                 headers={"User-Agent": self.USER_AGENT})
+        return self.session
+
+    @staticmethod
+    def _decoder(charset):
+        try:
+            return codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+        except LookupError:
+            return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    async def _fetch(self, url, parser):
+        # 缓存的 SQLite 读写与 zlib 压缩/解压在线程中执行，不阻塞共用的事件循环
+        cached = await asyncio.to_thread(self.cache.lookup, url) if self.cache is not None else None
+        if cached is not None and cached["fresh"]:
+            await asyncio.to_thread(self.cache.record_fresh_hit, cached)
+            parser.feed(self._decoder(cached["charset"]).decode(cached["body"], final=True))
+            return
+
+        headers = {}
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        async with self._get_session().get(url, proxy=self.proxy_url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                await asyncio.to_thread(self.cache.revalidated, url, response.headers, cached)
+                parser.feed(self._decoder(cached["charset"]).decode(cached["body"], final=True))
+                return
+            if response.status != 200 or "html" not in response.headers.get("Content-Type", "html"):
+                logger.info(f"跳过页面 {url}: HTTP {response.status} {response.headers.get('Content-Type')}")
+                return
+            decoder = self._decoder(response.charset)
+            body = bytearray()
+            complete = True
+            async for chunk in response.content.iter_chunked(16384):
+                parser.feed(decoder.decode(chunk))
+                body.extend(chunk)
+                if len(body) >= self.max_bytes:
+                    complete = False
+                    break
+        # 只缓存完整下载的页面；超时被取消的请求不会执行到这里
+        if self.cache is not None and complete:
+            await asyncio.to_thread(self.cache.store, url, response.headers, bytes(body), response.charset)
+
+    async def fetch_all(self, urls, deadline):
+        """
+        并发抓取 urls，deadline 秒后取消未完成的请求，已下载部分的正文仍然保留。
+        返回 {url: 段落列表}，没有正文的页面不在结果中。
+        """
+        parsers = {url: PageTextParser() for url in urls}
+        tasks = {asyncio.ensure_future(self._fetch(url, parser)): url for url, parser in parsers.items()}
+        if not tasks:
+            return {}
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+            logger.info(f"页面抓取超时: {tasks[task]}")
+        if pending:
+            await asyncio.wait(pending)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                logger.info(f"页面抓取失败: {tasks[task]}: {task.exception()}")
+        pages = {}
+        for url, parser in parsers.items():
+            try:
+                paragraphs = parser.text()
+            except Exception as e:
+                logger.info(f"页面解析失败: {url}: {e}")
+                continue
+            if paragraphs:
+                pages[url] = paragraphs
+        return pages
+
+    def close(self):
+        if self.session is not None and not self.session.closed:
+            self.async_loop.run(self.session.close(), timeout=5)
+
+class PageCache:
+    """
+    网页的本地 HTTP 缓存。
+    正文以 zlib 压缩后存入 SQLite；按 Cache-Control / Expires（以及 Last-Modified 启发式）计算新鲜期，
+    过期后凭 ETag / Last-Modified 发起条件请求，304 时沿用缓存正文。
+    压缩后的总大小超过 max_bytes 时按最近访问时间淘汰。
+    """
+
+    def __init__(self, db_path, max_bytes=100 * 1024 * 1024, default_ttl=3600, max_heuristic_ttl=86400):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.max_heuristic_ttl = max_heuristic_ttl
+        self.fresh_hits = 0
+        self.revalidations = 0
+        self.downloads = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages "
+                "(url TEXT PRIMARY KEY, body BLOB, size INTEGER, stored_size INTEGER, charset TEXT, "
+                "etag TEXT, last_modified TEXT, expires REAL, accessed REAL)"
+            )
+
+    def freshness(self, headers, now):
+        """
+        由响应头计算过期时间戳；返回 None 表示不应缓存（no-store）。
+        no-cache 的页面仍会保存，但每次使用前都要重新验证。
+        """
+        directives = {}
+        for item in headers.get("Cache-Control", "").split(","):
+            name, _, value = item.strip().partition("=")
+            if name:
+                directives[name.lower()] = value.strip('"')
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return now
+        age = int(headers["Age"]) if headers.get("Age", "").isdigit() else 0
+        if "max-age" in directives:
+            try:
+                return now + max(int(directives["max-age"]) - age, 0)
+            except ValueError:
+                return now
+        try:
+            if headers.get("Expires"):
+                expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+                date = parsedate_to_datetime(headers["Date"]).timestamp() if headers.get("Date") else now
+                return now + max(expires - date, 0)
+            if headers.get("Last-Modified"):
+                # 启发式新鲜期：距上次修改时间的 10%，最多 max_heuristic_ttl
+                modified = parsedate_to_datetime(headers["Last-Modified"]).timestamp()
+                return now + min(max(now - modified, 0) * 0.1, self.max_heuristic_ttl)
+        except (TypeError, ValueError):
+            return now
+        return now + self.default_ttl
+
+    def lookup(self, url):
+        """
+        返回缓存条目 {"body", "charset", "etag", "last_modified", "size", "fresh"}，未缓存时返回 None。
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body, charset, etag, last_modified, expires, size FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE pages SET accessed = ? WHERE url = ?", (time.time(), url))
+        body, charset, etag, last_modified, expires, size = row
+        return {
+            "body": zlib.decompress(body),
+            "charset": charset,
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": size,
+            "fresh": time.time() < expires,
+        }
+
+    def record_fresh_hit(self, entry):
+        with self.lock:
+            self.fresh_hits += 1
+            self.bytes_saved += entry["size"]
+
+    def revalidated(self, url, headers, entry):
+        """
+        条件请求返回 304：沿用缓存正文，按新的响应头更新新鲜期与校验器。
+        """
+        now = time.time()
+        expires = self.freshness(headers, now)
+        with self.lock:
+            self.revalidations += 1
+            self.bytes_saved += entry["size"]
+            with self.conn:
+                if expires is None:
+                    self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+                else:
+                    self.conn.execute(
+                        "UPDATE pages SET expires = ?, etag = COALESCE(?, etag), "
+                        "last_modified = COALESCE(?, last_modified), accessed = ? WHERE url = ?",
+                        (expires, headers.get("ETag"), headers.get("Last-Modified"), now, url)
+                    )
+
+    def store(self, url, headers, body, charset):
+        now = time.time()
+        expires = self.freshness(headers, now)
+        with self.lock:
+            self.downloads += 1
+        if expires is None:
+            return
+        compressed = zlib.compress(body, 6)
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO pages "
+                    "(url, body, size, stored_size, charset, etag, last_modified, expires, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (url, compressed, len(body), len(compressed), charset,
+                     headers.get("ETag"), headers.get("Last-Modified"), expires, now)
+                )
+                self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, stored_size in self.conn.execute(
+                "SELECT url, stored_size FROM pages ORDER BY accessed").fetchall():
+            self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            total -= stored_size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        with self.lock:
+            entries, stored_bytes = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(stored_size), 0) FROM pages").fetchone()
+            return {
+                "fresh_hits": self.fresh_hits,
+                "revalidated": self.revalidations,
+                "downloads": self.downloads,
+                "bytes_saved": self.bytes_saved,
+                "entries": entries,
+                "stored_bytes": stored_bytes,
+            }
+
+    def clear(self):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM pages")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class WebSearchClient:
+    """
+    长期复用的 Serper 搜索客户端。
+    在应用共用的事件循环中维护带连接池、keep-alive 与 DNS 缓存的 aiohttp 会话，
+    避免每次搜索都重新创建事件循环、解析域名和进行 TLS 握手。
+    """
+    SEARCH_URL = "https://google.serper.dev/search"
+
+    def __init__(self, async_loop, proxy_url=None, timeout=15, connect_timeout=5, pool_size=10,
+                 dns_ttl=300, keepalive_timeout=60):
+        self.async_loop = async_loop
+        self.proxy_url = proxy_url or None
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.pool_size = pool_size
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+    def _get_session(self):
+        # 会话必须在所属事件循环中创建，首次使用时延迟初始化
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def search(self, query, api_key, num=10):
+        """
+        发送一次搜索请求并返回 organic 结果列表，异常交由调用方处理。
+        """
+        headers = {
+            "X-API-KEY": api_key,
+            "Content-Type": "application/json"
+        }
+        async with self._get_session().post(
+            self.SEARCH_URL,
+            headers=headers,
+            json={"q": query, "num": num},
+            proxy=self.proxy_url
+        ) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data.get("organic", [])[:num]
+
+    def close(self):
+        """
+        关闭会话，释放连接池。
+        """
+        if self.session is not None and not self.session.closed:
+            self.async_loop.run(self.session.close(), timeout=5)
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
 
-    # 创建并设置事件循环
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
     window = MultiAI()
     window.show()
 